@@ -0,0 +1,83 @@
+"""Cost of the request instrumentation behind /metrics.
+
+    python benchmarks/bench_metrics.py --requests 20000
+
+Times ``/healthz`` through the Flask test client with the metrics hooks
+installed and with them removed, alternating between the two, and reports
+both plus the difference of their medians (``overhead_us``), which unlike
+the means is not swayed by the odd garbage collection pause. Also times
+the bare metric updates one request makes, without Flask around them
+(``metrics.updates``).
+"""
+import argparse
+import time
+
+from common import load_app, report, summarize
+
+
+def time_requests(client, requests):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        client.get('/healthz').get_data()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples, time.perf_counter() - start)
+
+
+def time_updates(main, requests):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        main.http_request_seconds.labels('/healthz').observe(0.001)
+        main.http_requests.labels('GET', '/healthz', 200).inc()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples, time.perf_counter() - start)
+
+
+def run(requests=20000, rounds=5, output=None):
+    main = load_app()
+    app = main.app
+    client = app.test_client()
+    hooks = [(app.before_request_funcs[None], main.start_request_timer),
+             (app.after_request_funcs[None], main.record_request_metrics)]
+    params = {'requests': requests}
+
+    # Alternate between the two in rounds so drift (CPU frequency, other
+    # load) hits both alike, and keep each one's fastest round
+    time_requests(client, min(requests, 1000))  # warm up
+    per_round = max(1, requests // rounds)
+    instrumented, bare = [], []
+    for _ in range(rounds):
+        instrumented.append(time_requests(client, per_round))
+        for funcs, hook in hooks:
+            funcs.remove(hook)
+        try:
+            bare.append(time_requests(client, per_round))
+        finally:
+            for funcs, hook in hooks:
+                funcs.append(hook)
+    instrumented = min(instrumented, key=lambda result: result['p50_ms'])
+    bare = min(bare, key=lambda result: result['p50_ms'])
+    instrumented['overhead_us'] = round((instrumented['p50_ms'] - bare['p50_ms']) * 1000, 2)
+
+    return [
+        report('metrics.request.bare', params, bare, output),
+        report('metrics.request.instrumented', params, instrumented, output),
+        report('metrics.updates', params, time_updates(main, requests), output),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=20000, help='requests with and without the hooks')
+    parser.add_argument('--rounds', type=int, default=5, help='alternations between the two')
+    parser.add_argument('--output', '-o', help='append JSON results to this file')
+    args = parser.parse_args()
+    records = run(args.requests, args.rounds, args.output)
+    print(f"overhead per request: {records[1]['overhead_us']}us")
+
+
+if __name__ == '__main__':
+    main()
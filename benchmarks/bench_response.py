@@ -0,0 +1,127 @@
+"""Micro-benchmarks for answering a message, over a large synthetic knowledge base.
+
+    python benchmarks/bench_response.py --intents 5000 --faq 5000 --messages 20000
+
+Measures, per message: the keyword automaton alone (``match``), FAQ
+retrieval alone (``faq``), and the whole ``get_response`` path with the
+response cache disabled (``get_response.cold``) and enabled
+(``get_response.warm``). Results are appended to ``--output`` as JSON
+lines tagged with the commit, for ``compare.py``.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from common import load_app, load_knowledge_phrases, message_corpus, report, summarize
+
+SYLLABLES = ('ba', 'co', 'de', 'fi', 'gu', 'ka', 'lo', 'me', 'ni', 'po', 'ra', 'si', 'tu', 've', 'zo', 'rek', 'mon', 'tal')
+
+
+def synthetic_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def synthetic_knowledge_base(directory, intents, faq, seed=0):
+    """Write the real knowledge base plus ``intents`` synthetic intents and
+    ``faq`` synthetic FAQ entries to ``directory``; returns the source path
+    and the synthetic phrases."""
+    rng = random.Random(seed)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, 'data', 'knowledge_base.json')) as f:
+        source = json.load(f)
+    with open(os.path.join(root, 'data', source['faq_corpus'])) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    # The word list is used as is, from where it lives
+    source['dictionary'] = os.path.join(root, 'data', source['dictionary'])
+
+    vocabulary = [synthetic_word(rng) for _ in range(max(100, intents))]
+    phrases = []
+    for i in range(intents):
+        keywords = [' '.join(rng.sample(vocabulary, rng.randint(1, 2))) for _ in range(rng.randint(1, 3))]
+        phrases.extend(keywords)
+        source['intents'].append({
+            'name': f'synthetic_{i}',
+            'priority': rng.randint(1, 5),
+            'keywords': keywords,
+            'response': f'Synthetic answer {i}.',
+        })
+    for i in range(faq):
+        question = ' '.join(rng.sample(vocabulary, rng.randint(3, 7)))
+        phrases.append(question)
+        entries.append({'question': question + '?', 'answer': f'Synthetic FAQ answer {i}.'})
+
+    source_path = os.path.join(directory, 'knowledge_base.json')
+    with open(source_path, 'w') as f:
+        json.dump(source, f)
+    with open(os.path.join(directory, source['faq_corpus']), 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    return source_path, phrases
+
+
+def time_each(function, messages):
+    samples = []
+    clock = time.perf_counter
+    start = clock()
+    for message in messages:
+        t0 = clock()
+        function(message)
+        samples.append(clock() - t0)
+    return summarize(samples, clock() - start)
+
+
+def run(intents=5000, faq=5000, messages=20000, seed=0, output=None):
+    main = load_app()
+    from cache import ResponseCache
+    from knowledge import KnowledgeBaseStore, compile_snapshot
+
+    params = {'intents': intents, 'faq': faq}
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        source_path, phrases = synthetic_knowledge_base(directory, intents, faq, seed)
+        snapshot_path = os.path.join(directory, 'knowledge_base.snap')
+        start = time.perf_counter()
+        compile_snapshot(source_path, snapshot_path)
+        records.append(report('compile_snapshot', params, summarize([time.perf_counter() - start], None), output))
+
+        store = KnowledgeBaseStore(source_path, snapshot_path, check_interval=3600)
+        kb = store.current()
+        corpus = message_corpus(load_knowledge_phrases() + phrases, messages, seed)
+        min_confidence = main.app.config['FAQ_MIN_CONFIDENCE']
+        records.append(report('match', params, time_each(kb.match, corpus), output))
+        records.append(report('faq', params, time_each(lambda m: kb.faq_answer(m, min_confidence), corpus), output))
+
+        saved = main.knowledge_base, main.response_cache
+        main.knowledge_base = store
+        try:
+            with main.app.app_context():
+                main.response_cache = ResponseCache(0)
+                cold = time_each(lambda m: main.get_response(m, 'benchmark'), corpus)
+                records.append(report('get_response.cold', params, cold, output))
+                main.response_cache = ResponseCache(main.app.config['RESPONSE_CACHE_SIZE'])
+                warm = time_each(lambda m: main.get_response(m, 'benchmark'), corpus)
+                warm['cache_hit_rate'] = round(main.response_cache.hits / len(corpus), 3)
+                records.append(report('get_response.warm', params, warm, output))
+        finally:
+            main.knowledge_base, main.response_cache = saved
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--intents', type=int, nargs='+', default=[5000],
+                        help='synthetic intents (several values run one after the other)')
+    parser.add_argument('--faq', type=int, default=5000, help='synthetic FAQ entries')
+    parser.add_argument('--messages', type=int, default=20000, help='messages in the corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', help='append JSON results to this file')
+    args = parser.parse_args()
+    for intents in args.intents:
+        run(intents, args.faq, args.messages, args.seed, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Cold start of a worker: interpreter, imports, create_app() and a first request.
+
+    python benchmarks/bench_startup.py --runs 10
+
+Each run starts a fresh interpreter on a scratch database and times
+``import main`` (``startup.import``), ``create_app()`` (``startup.create_app``)
+and the first ``/chat`` request (``startup.first_request``); ``startup.total``
+is the whole process from launch to exit. Workers forked from a preloaded
+server skip the first two.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT, report, summarize
+
+TARGET_SECONDS = 1.0  # import plus create_app(), at the median
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+app = main.create_app()
+t2 = time.perf_counter()
+app.test_client().post('/chat', json={'message': 'hello'})
+t3 = time.perf_counter()
+main.conversation_writer.flush()
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2}))
+'''
+
+
+def start_once(directory):
+    env = dict(
+        os.environ,
+        DATABASE_URL='sqlite:///' + os.path.join(directory, 'startup.db'),
+        CHATBOT_UPLOAD_FOLDER=json.dumps(os.path.join(directory, 'uploads')),
+        CHATBOT_RETENTION_IN_APP='false',
+        RATE_LIMIT_ENABLED='0',
+    )
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=os.path.join(ROOT, 'src'), env=env,
+        capture_output=True, text=True, check=True,
+    )
+    stages = json.loads(result.stdout.strip().splitlines()[-1])
+    stages['total'] = time.perf_counter() - started
+    return stages
+
+
+def run(runs=10, output=None):
+    samples = {'import': [], 'create_app': [], 'first_request': [], 'total': []}
+    elapsed = 0.0
+    start_once(tempfile.mkdtemp(prefix='chatbot-bench-'))  # warm the page cache and bytecode
+    for _ in range(runs):
+        stages = start_once(tempfile.mkdtemp(prefix='chatbot-bench-'))
+        elapsed += stages['total']
+        for stage, seconds in stages.items():
+            samples[stage].append(seconds)
+    params = {'runs': runs}
+    records = [report(f'startup.{stage}', params, summarize(values, elapsed), output)
+               for stage, values in samples.items()]
+    ready = sorted(i + c for i, c in zip(samples['import'], samples['create_app']))
+    records[-1]['ready_p50_s'] = round(ready[len(ready) // 2], 4)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to start')
+    parser.add_argument('--output', '-o', help='append JSON results to this file')
+    args = parser.parse_args()
+    ready = run(args.runs, args.output)[-1]['ready_p50_s']
+    print(f'import + create_app(): {ready}s at the median (target {TARGET_SECONDS}s)')
+    sys.exit(0 if ready <= TARGET_SECONDS else 1)
+
+
+if __name__ == '__main__':
+    main()
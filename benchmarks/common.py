@@ -0,0 +1,166 @@
+"""Shared helpers for the benchmarks: timing summaries, result records, corpora."""
+from datetime import datetime, timezone
+import functools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 4)
+
+
+def summarize(samples, elapsed, errors=0):
+    """Latency percentiles in milliseconds and throughput of one run."""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'throughput': round(len(ordered) / elapsed, 1) if elapsed else None,
+        'mean_ms': _ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': _ms(percentile(ordered, 0.50)),
+        'p95_ms': _ms(percentile(ordered, 0.95)),
+        'p99_ms': _ms(percentile(ordered, 0.99)),
+        'max_ms': _ms(ordered[-1]) if ordered else None,
+    }
+
+
+def git_revision():
+    """The commit being measured, marked ``-dirty`` with uncommitted changes."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_app():
+    """Import the app, on a scratch SQLite database unless DATABASE_URL is set.
+
+    Benchmarks write conversations, tickets and uploads; they must not land
+    in the development database by accident.
+    """
+    if 'main' not in sys.modules and 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='chatbot-bench-'), 'bench.db')
+    import main
+    main.create_app()
+    return main
+
+
+@functools.lru_cache(maxsize=None)
+def environment():
+    return {
+        'commit': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def report(name, params, result, output=None, env=None):
+    """Print one result line and append it as a JSON record to ``output``."""
+    record = {
+        'benchmark': name,
+        'params': params,
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        **(env or environment()),
+        **result,
+    }
+    label = ' '.join(f'{key}={value}' for key, value in params.items())
+    throughput = f"{result['throughput']:>10.1f}/s" if result.get('throughput') else ' ' * 12
+    print(
+        f"{name:<28} {label:<28} {throughput}  "
+        f"p50 {result['p50_ms']}ms  p95 {result['p95_ms']}ms  p99 {result['p99_ms']}ms"
+        + (f"  errors {result['errors']}" if result.get('errors') else '')
+    )
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return record
+
+
+# Message corpus
+
+FILLER = (
+    'hi', 'hey', 'so', 'um', 'please', 'thanks', 'quick question', 'i was wondering', 'can you tell me',
+    'for some reason', 'today', 'again', 'my account', 'on my phone', 'right now', 'asap',
+)
+
+UNMATCHED = (
+    'what is the meaning of life', 'do you like pizza', 'asdfghjkl', 'the weather is nice',
+    'who won the game last night', 'tell me a joke', 'ok', '???', 'lol',
+)
+
+
+def typo(rng, word):
+    """Drop, double or swap one letter, like a hurried typist."""
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return word[:i] + word[i + 1:]
+    if kind == 1:
+        return word[:i] + word[i] + word[i:]
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def message_corpus(phrases, count, seed=0, typo_rate=0.1, unmatched_rate=0.2):
+    """``count`` chat messages built around ``phrases`` the way users write them.
+
+    Each message wraps a known phrase in filler, misspells some words and
+    varies the case; a share of messages match nothing at all.
+    """
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        if rng.random() < unmatched_rate:
+            messages.append(rng.choice(UNMATCHED))
+            continue
+        words = rng.choice(phrases).split()
+        words = [typo(rng, word) if rng.random() < typo_rate else word for word in words]
+        parts = [rng.choice(FILLER), ' '.join(words)]
+        if rng.random() < 0.5:
+            parts.append(rng.choice(FILLER))
+        message = ' '.join(parts)
+        if rng.random() < 0.3:
+            message = message.capitalize() + rng.choice(('?', '!', '.', ''))
+        messages.append(message)
+    return messages
+
+
+def load_knowledge_phrases(path=os.path.join(ROOT, 'data', 'knowledge_base.json'), actions=False):
+    """Keywords and FAQ questions of a knowledge base, to seed message corpora.
+
+    Keywords of intents with actions (e.g. opening a ticket) are left out
+    unless ``actions`` is set, so benchmarks measure answering only.
+    """
+    with open(path) as f:
+        source = json.load(f)
+    phrases = [
+        keyword for intent in source['intents'] if actions or not intent.get('action')
+        for keyword in intent['keywords']
+    ]
+    if source.get('faq_corpus'):
+        with open(os.path.join(os.path.dirname(path), source['faq_corpus'])) as f:
+            phrases.extend(json.loads(line)['question'] for line in f if line.strip())
+    return phrases
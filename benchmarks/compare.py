@@ -0,0 +1,70 @@
+"""Compare benchmark results recorded at two commits.
+
+    python benchmarks/compare.py results.jsonl
+    python benchmarks/compare.py results.jsonl --base 1a2b3c4 --head 5d6e7f8
+
+Reads the JSON lines written with ``--output`` by the other benchmarks and
+prints, for each benchmark and parameter set measured at both commits,
+the latest result of each and the change. Without ``--base``/``--head``
+the two most recently measured commits are compared. Only compare runs
+from the same machine.
+"""
+import argparse
+import json
+
+METRICS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def load_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latest_by_key(records, commit):
+    """The most recent record of each (benchmark, params) measured at ``commit``."""
+    latest = {}
+    for record in records:
+        if record['commit'] == commit:
+            latest[(record['benchmark'], json.dumps(record['params'], sort_keys=True))] = record
+    return latest
+
+
+def change(base, head):
+    if base in (None, 0) or head is None:
+        return ''
+    return f'{(head - base) / base * 100:+.1f}%'
+
+
+def compare(records, base=None, head=None):
+    commits = list(dict.fromkeys(record['commit'] for record in records))
+    if head is None:
+        head = commits[-1]
+    if base is None:
+        earlier = [commit for commit in commits if commit != head]
+        if not earlier:
+            raise SystemExit('Results cover a single commit; nothing to compare')
+        base = earlier[-1]
+    before, after = latest_by_key(records, base), latest_by_key(records, head)
+
+    print(f'{base} -> {head}')
+    for key in sorted(before.keys() & after.keys()):
+        name, params = key
+        label = ' '.join(f'{k}={v}' for k, v in json.loads(params).items())
+        cells = [
+            f'{metric} {before[key][metric]} -> {after[key][metric]} {change(before[key][metric], after[key][metric])}'
+            for metric in METRICS if before[key].get(metric) is not None
+        ]
+        print(f'{name:<28} {label:<28} ' + '  '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('results', help='JSON lines written with --output')
+    parser.add_argument('--base', help='commit to compare against')
+    parser.add_argument('--head', help='commit to compare')
+    args = parser.parse_args()
+    compare(load_results(args.results), args.base, args.head)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Load generator for /chat, /upload and the admin endpoints.
+
+    python benchmarks/load.py --rows 0 10000 100000 --requests 2000 --concurrency 8
+    python benchmarks/load.py --url http://localhost:5000 --requests 5000 --concurrency 32
+
+Without ``--url`` requests go through the Flask test client in this
+process, which measures the app without any server in front of it. With
+``--url`` they go over real sockets (one keep-alive connection per client
+thread) to a running server, e.g. gunicorn.
+
+Before each run the conversation and ticket tables are filled up to
+``--rows`` rows (tickets get a tenth of that), so the admin endpoints are
+measured at realistic table sizes. Against a server, seeding needs the
+server's database: export the same ``DATABASE_URL`` for both.
+
+All client threads share one IP, so start the server under test with
+``RATE_LIMIT_ENABLED=0``; in-process runs turn the limiter off themselves.
+"""
+import argparse
+from datetime import datetime, timedelta
+import functools
+import http.client
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from common import load_app, load_knowledge_phrases, message_corpus, report, summarize
+
+ENDPOINTS = ('chat', 'upload', 'admin-conversations', 'admin-tickets')
+
+
+def build_request(endpoint, rng, corpus, upload_size, counter):
+    """Return ``(method, path, body, headers)`` for one request."""
+    if endpoint == 'chat':
+        body = json.dumps({'message': rng.choice(corpus)}).encode()
+        return 'POST', '/chat', body, {'Content-Type': 'application/json'}
+    if endpoint == 'upload':
+        # Unique content, so every upload is stored rather than deduplicated
+        body = f'{counter}-{rng.random()}\n'.encode().ljust(upload_size, b'x')
+        return 'POST', f'/upload?filename=bench-{counter}.txt', body, {'Content-Type': 'application/octet-stream'}
+    if endpoint == 'admin-conversations':
+        if rng.random() < 0.5:
+            return 'GET', f'/admin/conversations?session_id=bench-{rng.randrange(1000)}', None, {}
+        return 'GET', '/admin/conversations', None, {}
+    if endpoint == 'admin-tickets':
+        return 'GET', f"/admin/tickets?status=open&priority={rng.choice(('low', 'medium', 'high'))}", None, {}
+    raise ValueError(f'unknown endpoint: {endpoint}')
+
+
+def seed(main, rows, batch_size=5000):
+    """Top the conversation and ticket tables up to ``rows`` and ``rows // 10`` rows."""
+    db = main.db
+    now = datetime.utcnow()
+    rng = random.Random(rows)
+    with main.app.app_context():
+        main.conversation_writer.flush()
+        existing = db.session.execute(db.select(db.func.count()).select_from(main.Conversation)).scalar()
+        for start in range(existing, rows, batch_size):
+            db.session.execute(db.insert(main.Conversation), [{
+                'session_id': f'bench-{i % 1000}',
+                'message': 'How do I reset my password?',
+                'response': 'You can reset your password from the login page.',
+                'timestamp': now - timedelta(seconds=rng.randrange(30 * 86400)),
+                'user_type': 'user',
+            } for i in range(start, min(rows, start + batch_size))])
+            db.session.commit()
+        existing = db.session.execute(db.select(db.func.count()).select_from(main.SupportTicket)).scalar()
+        for start in range(existing, rows // 10, batch_size):
+            db.session.execute(db.insert(main.SupportTicket), [{
+                'session_id': f'bench-ticket-{i}',
+                'status': rng.choice(('open', 'assigned', 'closed')),
+                'priority': rng.choice(('low', 'medium', 'high')),
+                'created_at': now - timedelta(seconds=rng.randrange(30 * 86400)),
+            } for i in range(start, min(rows // 10, start + batch_size))])
+            db.session.commit()
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPTransport:
+    """One keep-alive connection that carries the session cookie like a browser."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=30)
+        self.cookie = None
+
+    def request(self, method, path, body, headers):
+        if self.cookie:
+            headers = dict(headers, Cookie=self.cookie)
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status
+
+
+def run_endpoint(endpoint, make_transport, requests, concurrency, corpus, upload_size, seed_value=0):
+    """Send ``requests`` requests from ``concurrency`` client threads and summarize them."""
+    samples, errors = [], [0]
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def client(index, count):
+        rng = random.Random(seed_value * 1000 + index)
+        transport = make_transport()
+        mine, failed = [], 0
+        for n in range(count):
+            request = build_request(endpoint, rng, corpus, upload_size, f'{index}-{n}')
+            start = time.perf_counter()
+            try:
+                status = transport.request(*request)
+            except Exception:
+                status = None
+                transport = make_transport()
+            mine.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                failed += 1
+        with lock:
+            samples.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(i, n)) for i, n in enumerate(per_thread) if n]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.perf_counter() - start, errors[0])
+
+
+def run(rows=(0,), endpoints=ENDPOINTS, requests=1000, concurrency=4, url=None, upload_size=16 * 1024,
+        messages=5000, output=None):
+    main = load_app() if url is None or 'DATABASE_URL' in os.environ else None
+    if url is None:
+        main.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='chatbot-bench-uploads-')
+        rate_limit_enabled, main.app.config['RATE_LIMIT_ENABLED'] = main.app.config['RATE_LIMIT_ENABLED'], False
+        make_transport = functools.partial(TestClientTransport, main.app)
+    else:
+        make_transport = functools.partial(HTTPTransport, url)
+    corpus = message_corpus(load_knowledge_phrases(), messages)
+
+    records = []
+    for row_count in rows:
+        if main is not None:
+            seed(main, row_count)
+        elif row_count:
+            print('Not seeding: set DATABASE_URL to the database of the server under test')
+        params = {'mode': 'http' if url else 'inprocess', 'rows': row_count, 'concurrency': concurrency}
+        for endpoint in endpoints:
+            result = run_endpoint(endpoint, make_transport, requests, concurrency, corpus, upload_size)
+            records.append(report(f'load.{endpoint}', params, result, output))
+    if main is not None:
+        main.conversation_writer.flush()
+        main.upload_processor.flush()
+    if url is None:
+        main.app.config['RATE_LIMIT_ENABLED'] = rate_limit_enabled
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='base URL of a running server; default is in-process')
+    parser.add_argument('--rows', type=int, nargs='+', default=[0, 10000], help='conversation rows to seed before each run')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint and table size')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads')
+    parser.add_argument('--upload-size', type=int, default=16 * 1024, help='bytes per upload')
+    parser.add_argument('--output', '-o', help='append JSON results to this file')
+    args = parser.parse_args()
+    run(args.rows, args.endpoints, args.requests, args.concurrency, args.url, args.upload_size, output=args.output)
+
+
+if __name__ == '__main__':
+    main()
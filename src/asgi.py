@@ -0,0 +1,251 @@
+"""ASGI entry point: chat over WebSockets next to the regular Flask routes.
+
+Run with an ASGI server, for example::
+
+    gunicorn --preload -k uvicorn.workers.UvicornWorker --pythonpath src asgi:application
+
+Each chat tab holds one WebSocket on ``/ws`` and costs a coroutine rather
+than a worker, so a process can keep many thousands of idle tabs open.
+Agents can follow ticket and message events on ``/ws/agents``, filtered by
+the same query parameters as ``/admin/events``, which is served on the
+event loop too so an open stream never ties up a thread.
+Chat turns touch the database, so they run on a small thread pool and
+never block the event loop. Every other request, including the ``/chat``
+POST fallback, is passed to the Flask app by :class:`wsgibridge.WsgiBridge`
+on a pool of ``ASGI_HTTP_THREADS`` threads, with request and response
+bodies streamed rather than buffered.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+from urllib.parse import parse_qsl
+import uuid
+
+from werkzeug.http import dump_cookie, parse_cookie
+
+from events import Subscription, parse_filters
+from main import chat_turn, conversation_writer, create_app, event_bus, format_event, rate_limit_wait
+from wsgibridge import WsgiBridge
+
+app = create_app()
+
+CHAT_PATH = '/ws'
+AGENT_PATH = '/ws/agents'
+EVENTS_PATH = '/admin/events'
+
+chat_executor = ThreadPoolExecutor(app.config['ASGI_CHAT_THREADS'], thread_name_prefix='chat')
+http_executor = ThreadPoolExecutor(app.config['ASGI_HTTP_THREADS'], thread_name_prefix='http')
+wsgi_application = WsgiBridge(app, http_executor)
+
+
+def _headers(scope):
+    return {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def same_origin(headers):
+    # Browsers send cookies with cross-site WebSocket handshakes, so only
+    # pages served from this host may open a chat socket
+    origin = headers.get('origin')
+    if origin is None:
+        return True
+    return origin.split('://', 1)[-1] == headers.get('host')
+
+
+def open_session(headers):
+    """Return the chat session id of the handshake, and a cookie if it is new.
+
+    The id lives in Flask's signed session cookie, so a socket and the
+    HTTP routes of the same tab share one chat session.
+    """
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = parse_cookie(headers.get('cookie', '')).get(app.config['SESSION_COOKIE_NAME'])
+    data = {}
+    if value:
+        try:
+            data = serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            data = {}
+    if 'session_id' in data:
+        return data['session_id'], None
+    data['session_id'] = str(uuid.uuid4())
+    cookie = dump_cookie(
+        app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(data),
+        path=app.config['SESSION_COOKIE_PATH'] or '/',
+        secure=app.config['SESSION_COOKIE_SECURE'],
+        httponly=app.config['SESSION_COOKIE_HTTPONLY'],
+        samesite=app.config['SESSION_COOKIE_SAMESITE'],
+    )
+    return data['session_id'], cookie
+
+
+def run_chat_turn(message, session_id):
+    with app.app_context():
+        return chat_turn(message, session_id)
+
+
+async def chat_socket(scope, receive, send):
+    """Answer JSON ``{"message": ...}`` frames with the same JSON as /chat."""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    headers = _headers(scope)
+    if not same_origin(headers):
+        # Closing before accepting rejects the handshake with a 403
+        await send({'type': 'websocket.close', 'code': 1008})
+        return
+    session_id, cookie = open_session(headers)
+    accept = {'type': 'websocket.accept'}
+    if cookie is not None:
+        accept['headers'] = [(b'set-cookie', cookie.encode('latin-1'))]
+    await send(accept)
+
+    client_ip = (scope.get('client') or (None,))[0]
+    while True:
+        event = await receive()
+        if event['type'] == 'websocket.disconnect':
+            return
+        reply = await answer_frame(event, session_id, client_ip)
+        await send({'type': 'websocket.send', 'text': json.dumps(reply)})
+
+
+async def answer_frame(event, session_id, client_ip):
+    """The reply to one ``websocket.receive`` frame, rate limited like /chat."""
+    text = event.get('text')
+    if text is None:
+        text = (event.get('bytes') or b'').decode('utf-8', 'replace')
+    try:
+        message = json.loads(text).get('message', '')
+        if not isinstance(message, str):
+            raise ValueError
+    except (ValueError, AttributeError):
+        return {'error': 'Expected a JSON object with a "message" string'}
+    wait = rate_limit_wait('chat', session_id, client_ip)
+    if wait:
+        return {'error': 'Too many requests, slow down', 'retry_after': math.ceil(wait)}
+    return await asyncio.get_running_loop().run_in_executor(chat_executor, run_chat_turn, message, session_id)
+
+
+class SocketSubscription(Subscription):
+    """A subscription whose events are awaited on the event loop."""
+
+    def __init__(self, filters, max_pending, loop):
+        super().__init__(filters, max_pending)
+        self._queue = asyncio.Queue(max_pending)
+        self._loop = loop
+
+    def put(self, event):
+        # Events are published from worker threads
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def get(self):
+        return await self._queue.get()
+
+
+async def _wait_for_disconnect(receive, kind='websocket.disconnect'):
+    while (await receive())['type'] != kind:
+        pass
+
+
+async def agent_socket(scope, receive, send):
+    """Push the ticket and message events matching the query string."""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if not same_origin(_headers(scope)):
+        await send({'type': 'websocket.close', 'code': 1008})
+        return
+    filters = parse_filters(dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))))
+    subscription = SocketSubscription(filters, app.config['EVENT_MAX_PENDING'], asyncio.get_running_loop())
+    event_bus.subscribe(subscription)
+    try:
+        await send({'type': 'websocket.accept'})
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        while True:
+            next_event = asyncio.ensure_future(subscription.get())
+            await asyncio.wait({disconnected, next_event}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                next_event.cancel()
+                return
+            await send({'type': 'websocket.send', 'text': json.dumps(next_event.result())})
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+async def sse_messages(subscription, disconnected, keepalive):
+    """Yield Server-Sent Events from ``subscription`` until ``disconnected`` is done."""
+    yield ': connected\n\n'
+    next_event = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            await asyncio.wait({disconnected, next_event}, timeout=keepalive, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                return
+            if next_event.done():
+                yield format_event(next_event.result())
+                next_event = asyncio.ensure_future(subscription.get())
+            else:
+                # Comments keep proxies from closing an idle stream
+                yield ': keepalive\n\n'
+    finally:
+        next_event.cancel()
+
+
+async def event_stream(scope, receive, send):
+    """``GET /admin/events`` as Server-Sent Events, like the Flask route but on the event loop."""
+    filters = parse_filters(dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))))
+    subscription = SocketSubscription(filters, app.config['EVENT_MAX_PENDING'], asyncio.get_running_loop())
+    event_bus.subscribe(subscription)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive, 'http.disconnect'))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        async for message in sse_messages(subscription, disconnected, app.config['EVENT_KEEPALIVE']):
+            await send({'type': 'http.response.body', 'body': message.encode('utf-8'), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        event_bus.unsubscribe(subscription)
+
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await asyncio.get_running_loop().run_in_executor(chat_executor, conversation_writer.close)
+            chat_executor.shutdown(wait=False)
+            http_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if scope['path'] == CHAT_PATH:
+            await chat_socket(scope, receive, send)
+        elif scope['path'] == AGENT_PATH:
+            await agent_socket(scope, receive, send)
+        else:
+            await receive()
+            await send({'type': 'websocket.close', 'code': 1008})
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['path'] == EVENTS_PATH and scope['method'] == 'GET':
+        await event_stream(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
@@ -0,0 +1,52 @@
+"""Static pages rendered once at startup and served with HTTP caching."""
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import os
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StaticAsset:
+    """A file held in memory with precompressed variants.
+
+    Responses carry a per-variant ETag, Last-Modified and Cache-Control, and
+    conditional requests are answered with 304 Not Modified.
+    """
+
+    def __init__(self, path, mimetype):
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.mimetype = mimetype
+        self.last_modified = datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        # Each encoding is a different representation, so each gets its own ETag
+        self.variants = {'identity': (body, digest)}
+        self.variants['gzip'] = (gzip.compress(body, 9, mtime=0), digest + '-gz')
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body), digest + '-br')
+
+    def negotiate(self, request):
+        accepted = request.accept_encodings
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted.quality(encoding) > 0:
+                return encoding
+        return 'identity'
+
+    def response(self, request, max_age):
+        encoding = self.negotiate(request)
+        body, etag = self.variants[encoding]
+        response = Response(body, mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response.make_conditional(request)
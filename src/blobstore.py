@@ -0,0 +1,197 @@
+"""Content-addressed storage for uploaded files.
+
+Blobs are stored once per distinct content under the hex SHA-256 of their
+bytes, so the same screenshot uploaded ten times takes the disk space of
+one. Uploads are streamed through in fixed-size chunks and hashed on the
+way, so memory use per upload does not depend on the file size.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+
+_UPLOAD_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class OffsetMismatch(Exception):
+    """A resumable upload chunk does not start where the upload stands."""
+
+    def __init__(self, offset):
+        super().__init__(f'upload is at offset {offset}')
+        self.offset = offset
+
+
+def _stale_files(directory, cutoff, pattern=None):
+    """Paths in ``directory`` last modified before ``cutoff``, if their names match ``pattern``."""
+    if not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if pattern is not None and not pattern.fullmatch(filename):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                yield path
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """Stores blobs under ``root`` and keeps resumable uploads in progress.
+
+    A blob lives at ``<root>/ab/cd/abcd...`` and is referred to by that
+    relative name. Incomplete resumable uploads live in ``<root>/partial``
+    next to a JSON file holding their metadata, so any worker can continue
+    an upload another one started.
+    """
+
+    def __init__(self, root, chunk_size=64 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self._tmp_dir = os.path.join(root, 'tmp')
+        self._partial_dir = os.path.join(root, 'partial')
+
+    def name(self, digest):
+        return os.path.join(digest[:2], digest[2:4], digest)
+
+    def thumbnail_name(self, digest):
+        return os.path.join('thumbnails', digest[:2], digest + '.png')
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def _copy(self, stream, out, digest, size, max_size):
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                return size
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise UploadTooLarge(f'upload exceeds {max_size} bytes')
+            if digest is not None:
+                digest.update(chunk)
+            out.write(chunk)
+
+    def _commit(self, tmp_path, digest):
+        """Move a fully written temp file into place; returns ``(name, created)``."""
+        name = self.name(digest)
+        path = self.path(name)
+        try:
+            # Identical content is already stored; touching it keeps the
+            # retention job from sweeping it before the new row points to it
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            os.unlink(tmp_path)
+            return name, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return name, True
+
+    def write(self, stream, max_size=None):
+        """Store everything readable from ``stream``.
+
+        Returns ``(name, digest, size, created)``; ``created`` is False when
+        the content was already stored.
+        """
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                size = self._copy(stream, out, digest, 0, max_size)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        name, created = self._commit(tmp_path, digest.hexdigest())
+        return name, digest.hexdigest(), size, created
+
+    # Resumable uploads
+
+    def _partial(self, upload_id):
+        if not _UPLOAD_ID_RE.fullmatch(upload_id):
+            raise KeyError(upload_id)
+        return os.path.join(self._partial_dir, upload_id)
+
+    def begin(self, size, metadata):
+        """Start a resumable upload of ``size`` bytes and return its id."""
+        os.makedirs(self._partial_dir, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        path = self._partial(upload_id)
+        with open(path + '.json', 'w') as f:
+            json.dump(dict(metadata, size=size), f)
+        open(path, 'wb').close()
+        return upload_id
+
+    def metadata(self, upload_id):
+        try:
+            with open(self._partial(upload_id) + '.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+
+    def offset(self, upload_id):
+        try:
+            return os.path.getsize(self._partial(upload_id))
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+
+    def append(self, upload_id, offset, stream):
+        """Append a chunk starting at ``offset`` and return the new offset."""
+        size = self.metadata(upload_id)['size']
+        current = self.offset(upload_id)
+        if offset != current:
+            raise OffsetMismatch(current)
+        with open(self._partial(upload_id), 'ab') as out:
+            try:
+                return self._copy(stream, out, None, current, size)
+            except UploadTooLarge:
+                # Keep the upload resumable from where it stood
+                out.truncate(current)
+                raise
+
+    def finish(self, upload_id):
+        """Store a complete resumable upload; returns ``(name, digest, size, created)``."""
+        path = self._partial(upload_id)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        os.unlink(path + '.json')
+        name, created = self._commit(path, digest.hexdigest())
+        return name, digest.hexdigest(), size, created
+
+    # Housekeeping
+
+    def blobs(self):
+        """Yield ``(name, digest)`` for every stored blob and thumbnail."""
+        if not os.path.isdir(self.root):
+            return
+        for top in sorted(os.listdir(self.root)):
+            if len(top) != 2 and top != 'thumbnails':
+                continue
+            for sub in sorted(os.listdir(self.path(top))):
+                directory = os.path.join(top, sub)
+                if not os.path.isdir(self.path(directory)):
+                    continue
+                for filename in os.listdir(self.path(directory)):
+                    # Thumbnails are <digest>.png
+                    yield os.path.join(directory, filename), filename.split('.', 1)[0]
+
+    def incomplete(self, max_age):
+        """Paths of resumable uploads and temp files untouched for ``max_age`` seconds."""
+        cutoff = time.time() - max_age
+        for path in _stale_files(self._partial_dir, cutoff, _UPLOAD_ID_RE):
+            yield path + '.json'
+            yield path
+        yield from _stale_files(self._tmp_dir, cutoff)
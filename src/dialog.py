@@ -0,0 +1,100 @@
+"""Per-session dialog state: which answer's follow-ups a session may pick from."""
+from array import array
+from collections import OrderedDict
+import threading
+import time
+
+NO_STATE = -1
+
+
+class DialogStates:
+    """Maps sessions to dialog states (small integers) that expire when idle.
+
+    A session's state lives in a slot of two parallel arrays, the state and
+    the time it expires, so each tracked session costs one dict entry plus
+    twelve bytes. Freed slots are reused. Sessions are kept in the order
+    they were last set, which with a single ``ttl`` is the order they
+    expire, so with ``max_sessions`` slots in use the expired ones at the
+    front, or else the one closest to expiring, are reclaimed without a
+    scan. States belong to one knowledge base version; setting or
+    reading with another version forgets them all, as intent ids change.
+    """
+
+    def __init__(self, max_sessions=10000, ttl=300.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.version = None
+        self._slots = OrderedDict()  # session id -> slot, least recently set first
+        self._owners = []  # slot -> session id, None when free
+        self._states = array('i')
+        self._expires = array('d')
+        self._free = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._slots.clear()
+            self._owners = []
+            self._states = array('i')
+            self._expires = array('d')
+            self._free = []
+            self.version = version
+
+    def _release(self, slot):
+        del self._slots[self._owners[slot]]
+        self._owners[slot] = None
+        self._states[slot] = NO_STATE
+        self._expires[slot] = 0.0
+        self._free.append(slot)
+
+    def _allocate(self, session_id, now):
+        if not self._free:
+            if len(self._states) < self.max_sessions:
+                self._owners.append(None)
+                self._states.append(NO_STATE)
+                self._expires.append(0.0)
+                self._free.append(len(self._states) - 1)
+            else:
+                # The front one is the closest to expiring; reclaim it and any others already expired
+                self._release(next(iter(self._slots.values())))
+                while self._slots:
+                    slot = next(iter(self._slots.values()))
+                    if self._expires[slot] >= now:
+                        break
+                    self._release(slot)
+        slot = self._free.pop()
+        self._owners[slot] = session_id
+        self._slots[session_id] = slot
+        return slot
+
+    def get(self, session_id, version):
+        """Return the state of ``session_id``, or None if it has none."""
+        with self._lock:
+            self._check_version(version)
+            slot = self._slots.get(session_id)
+            if slot is None:
+                return None
+            if self._expires[slot] < time.monotonic():
+                self._release(slot)
+                return None
+            return self._states[slot]
+
+    def set(self, session_id, version, state):
+        """Put ``session_id`` in ``state``, or clear its state if ``state`` is None."""
+        with self._lock:
+            self._check_version(version)
+            slot = self._slots.get(session_id)
+            if state is None:
+                if slot is not None:
+                    self._release(slot)
+                return
+            now = time.monotonic()
+            if slot is None:
+                slot = self._allocate(session_id, now)
+            else:
+                self._slots.move_to_end(session_id)
+            self._states[slot] = state
+            self._expires[slot] = now + self.ttl
@@ -0,0 +1,221 @@
+"""Publish/subscribe for live ticket and message events.
+
+Events are plain dicts ``{'type': ..., 'time': ..., 'data': {...}}``. A
+publisher hands them to the subscribers of its own process and, through a
+:class:`UnixSocketRelay`, to every other worker process on the host, so an
+agent connected to any worker sees events raised by all of them.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Event fields subscribers may filter on, e.g. ?priority=high,medium
+FILTER_FIELDS = ('type', 'priority', 'status', 'session_id')
+
+# Unix datagrams are delivered whole; larger events are not relayed
+MAX_DATAGRAM = 64 * 1024
+
+
+def parse_filters(args):
+    """Turn ``{'priority': 'high,medium'}`` style arguments into event filters."""
+    filters = {}
+    for field in FILTER_FIELDS:
+        value = args.get(field)
+        if value:
+            filters[field] = set(value.split(','))
+    return filters
+
+
+class Subscription:
+    """A subscriber's bounded inbox of events matching its filters.
+
+    Publishers never wait on a slow subscriber: when the inbox is full,
+    new events are dropped and counted in ``dropped``.
+    """
+
+    def __init__(self, filters=None, max_pending=1000):
+        self.filters = filters or {}
+        self.dropped = 0
+        self._queue = queue.Queue(max_pending)
+
+    def matches(self, event):
+        for field, allowed in self.filters.items():
+            value = event['type'] if field == 'type' else event['data'].get(field)
+            if value is None or str(value) not in allowed:
+                return False
+        return True
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrived within ``timeout``."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class UnixSocketRelay:
+    """Fans events out to the other processes sharing ``directory``.
+
+    Each process binds its own datagram socket in the directory and sends
+    every event it publishes to all the other sockets found there, so no
+    separate broker process is needed. Sockets left behind by processes
+    that died are removed the first time a send to them fails.
+    """
+
+    def __init__(self, directory, deliver):
+        self.directory = directory
+        self.deliver = deliver
+        self.sent = 0
+        self.dropped = 0
+        self._pid = None
+        self._path = None
+        self._sock = None
+        self._peers = []
+        self._peers_mtime = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked worker must not read from its parent's socket
+            self._sock = None
+            self._peers_mtime = None
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                sock.bind(self._path)
+            except OSError:
+                # Too long a path (about 108 bytes) or an unwritable directory;
+                # events then only reach this process's subscribers
+                sock.close()
+                logger.exception('Cannot relay events through %s', self._path)
+                return
+            self._sock = sock
+            threading.Thread(target=self._run, args=(sock,), name='event-relay', daemon=True).start()
+
+    def start(self):
+        self._ensure_started()
+
+    def peers(self):
+        # The directory only changes when a worker starts or exits
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime != self._peers_mtime:
+            self._peers = [
+                os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.sock') and os.path.join(self.directory, name) != self._path
+            ]
+            self._peers_mtime = mtime
+        return self._peers
+
+    def send(self, event):
+        self._ensure_started()
+        if self._sock is None:
+            return
+        payload = json.dumps(event).encode('utf-8')
+        if len(payload) > MAX_DATAGRAM:
+            self.dropped += 1
+            logger.warning('Not relaying %s event of %d bytes', event['type'], len(payload))
+            return
+        for path in self.peers():
+            try:
+                self._sock.sendto(payload, socket.MSG_DONTWAIT, path)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody reads this socket any more
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # The peer is not keeping up; drop rather than stall the request
+                self.dropped += 1
+
+    def _run(self, sock):
+        while True:
+            try:
+                payload = sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                self.deliver(json.loads(payload))
+            except Exception:
+                logger.exception('Failed to deliver relayed event')
+
+    def close(self):
+        if self._pid != os.getpid() or self._sock is None:
+            return
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+        self._sock.close()
+        self._pid = None
+
+
+class EventBus:
+    """Delivers published events to every matching subscription.
+
+    With ``relay_directory`` set, events also reach the subscribers of the
+    other worker processes through a :class:`UnixSocketRelay`.
+    """
+
+    def __init__(self, relay_directory=None):
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self.relay = None
+        self.configure(relay_directory)
+
+    def configure(self, relay_directory=None):
+        """Relay events through ``relay_directory`` from now on, or through none if it is None."""
+        if self.relay is not None:
+            self.relay.close()
+        self.relay = None
+        if relay_directory and hasattr(socket, 'AF_UNIX'):
+            self.relay = UnixSocketRelay(relay_directory, self._dispatch)
+
+    def subscribe(self, subscription):
+        if self.relay is not None:
+            # Start receiving from the other workers before the first event
+            self.relay.start()
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def publish(self, event_type, data):
+        event = {'type': event_type, 'time': time.time(), 'data': data}
+        self._dispatch(event)
+        if self.relay is not None:
+            self.relay.send(event)
+        return event
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
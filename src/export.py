@@ -0,0 +1,75 @@
+"""Streaming export of table rows as NDJSON or CSV.
+
+Every function here consumes and produces iterators, so an export of any
+size is held in memory one chunk at a time.
+"""
+import csv
+from datetime import date, datetime
+import io
+import json
+import zlib
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def iter_ndjson(records):
+    for record in records:
+        yield json.dumps({key: _plain(value) for key, value in record.items()}) + '\n'
+
+
+def iter_csv(records, fieldnames):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+    for record in records:
+        writer.writerow([_plain(record[name]) for name in fieldnames])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_chunks(pieces, chunk_size=CHUNK_SIZE):
+    """Join small text pieces into encoded chunks of about ``chunk_size`` bytes."""
+    parts, size = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(parts)
+            parts, size = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def iter_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(records, fmt, fieldnames, compress=False):
+    """Serialize ``records`` (mappings) to a stream of byte chunks."""
+    if fmt == 'ndjson':
+        pieces = iter_ndjson(records)
+    elif fmt == 'csv':
+        pieces = iter_csv(records, fieldnames)
+    else:
+        raise ValueError(f'unsupported export format: {fmt}')
+    chunks = iter_chunks(pieces)
+    return iter_gzip(chunks) if compress else chunks
@@ -0,0 +1,59 @@
+"""Hot, bounded per-session conversation history."""
+from collections import OrderedDict, deque
+import threading
+import time
+
+
+class _Entry:
+    __slots__ = ('turns', 'fresh_until')
+
+    def __init__(self, turns, maxlen, fresh_until):
+        self.turns = deque(turns, maxlen=maxlen)
+        self.fresh_until = fresh_until
+
+
+class SessionHistory:
+    """Keeps the latest turns of recently active sessions in ring buffers.
+
+    Each session holds at most ``turns_per_session`` turns and at most
+    ``max_sessions`` sessions are kept, evicting the least recently used.
+    A session's buffer is filled from the database by :meth:`load` and then
+    extended by :meth:`append` as this process handles its turns. Other
+    worker processes may serve turns of the same session, so a buffer is
+    trusted for ``ttl`` seconds after loading and reloaded after that.
+    """
+
+    def __init__(self, turns_per_session=50, max_sessions=10000, ttl=30.0):
+        self.turns_per_session = turns_per_session
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        """Return the buffered turns oldest first, or None if they must be loaded."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry.fresh_until < time.monotonic():
+                return None
+            self._sessions.move_to_end(session_id)
+            return list(entry.turns)
+
+    def load(self, session_id, turns):
+        """Replace the buffer of ``session_id`` with ``turns`` (oldest first)."""
+        with self._lock:
+            self._sessions[session_id] = _Entry(turns, self.turns_per_session, time.monotonic() + self.ttl)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def append(self, session_id, turn):
+        """Add a turn to a buffered session; unbuffered sessions load on demand."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.turns.append(turn)
+                self._sessions.move_to_end(session_id)
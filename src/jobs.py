@@ -0,0 +1,131 @@
+"""Background jobs run on a pool of worker processes, off the request path."""
+import atexit
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """Feeds queued jobs to a process pool and records their outcome.
+
+    The queue itself lives wherever ``claim`` and ``complete`` keep it:
+    ``claim(limit)`` atomically marks up to ``limit`` queued jobs as running
+    and returns them as ``(job_id, args)``, and ``complete(job_id, result,
+    error)`` stores what ``function(*args)`` returned or the error it
+    raised. Several runners may share one queue; each job is claimed once.
+
+    A dispatcher thread started by :meth:`notify` keeps the pool busy until
+    nothing is left to claim, then sleeps until the next notify or for
+    ``poll_interval`` seconds, which picks up jobs queued by other processes.
+    """
+
+    def __init__(self, function, claim, complete, workers=2, poll_interval=5.0):
+        self.function = function
+        self.claim = claim
+        self.complete = complete
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = 0
+        self._pid = None
+        self._thread = None
+        self._pool = None
+        self._stopping = False
+        self._wake = threading.Event()
+        self._requested = 0
+        self._finished = 0
+        self._idle = threading.Condition()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._idle:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            # A forked worker inherits neither the thread nor a usable pool
+            self._pool = None
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """Tell the runner new jobs are queued."""
+        self._ensure_started()
+        with self._idle:
+            self._requested += 1
+        self._wake.set()
+
+    def flush(self):
+        """Wait until every job queued before this call has been run."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._idle:
+            target = self._requested
+            while self._finished < target and self._thread.is_alive():
+                self._idle.wait(self.poll_interval)
+
+    def close(self):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(self.poll_interval)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._idle:
+                requested = self._requested
+            try:
+                self.run_until_idle()
+            except Exception:
+                logger.exception('Job dispatch failed')
+            with self._idle:
+                self._finished = requested
+                self._idle.notify_all()
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Forking a process that runs threads is unsafe, so workers are
+            # spawned fresh; they import only the module of ``function``
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def run_until_idle(self):
+        """Run jobs in the calling thread until none are left to claim."""
+        running = {}
+        while not self._stopping:
+            capacity = self.workers - len(running)
+            jobs = self.claim(capacity) if capacity > 0 else []
+            for job_id, args in jobs:
+                running[self._get_pool().submit(self.function, *args)] = job_id
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._finish(running.pop(future), future)
+
+    def _finish(self, job_id, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker died (e.g. out of memory); start a fresh pool
+                self._pool = None
+            self.failed += 1
+            logger.warning('Job %s failed: %r', job_id, e)
+            self.complete(job_id, None, repr(e))
+        else:
+            self.completed += 1
+            self.complete(job_id, result, None)
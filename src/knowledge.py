@@ -0,0 +1,240 @@
+"""Knowledge base: chat intents and FAQ content compiled into one snapshot.
+
+Content is edited in ``data/knowledge_base.json`` and the FAQ corpus it
+references. :func:`compile_snapshot` turns both into a single read-only
+snapshot holding the intent table, the keyword automaton and the FAQ
+retrieval index. Worker processes memory-map that file, so its pages are
+shared between them, and :class:`KnowledgeBaseStore` switches to a newer
+snapshot as soon as one is written, so content edits go live without a
+redeploy.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from matcher import KeywordMatcher, load_words
+from retrieval import FAQIndex, load_corpus
+from snapshot import Snapshot, SnapshotWriter
+
+logger = logging.getLogger(__name__)
+
+Intent = namedtuple('Intent', 'name response action')
+
+
+def compile_snapshot(source_path, snapshot_path):
+    """Compile the knowledge base at ``source_path`` and return its version."""
+    with open(source_path, 'rb') as f:
+        raw = f.read()
+    source = json.loads(raw)
+    digest = hashlib.sha256(raw)
+    sources = [os.path.abspath(source_path)]
+
+    entries = []
+    if source.get('faq_corpus'):
+        corpus_path = os.path.join(os.path.dirname(os.path.abspath(source_path)), source['faq_corpus'])
+        with open(corpus_path, 'rb') as f:
+            digest.update(f.read())
+        entries = load_corpus(corpus_path)
+        sources.append(corpus_path)
+
+    words = set()
+    if source.get('dictionary'):
+        dictionary_path = os.path.join(os.path.dirname(os.path.abspath(source_path)), source['dictionary'])
+        with open(dictionary_path, 'rb') as f:
+            digest.update(f.read())
+        words = load_words(dictionary_path)
+        sources.append(dictionary_path)
+
+    intents = source['intents']
+    matcher = KeywordMatcher()
+    for intent_id, intent in enumerate(intents):
+        for keyword in intent['keywords']:
+            matcher.add(keyword, intent_id, intent.get('priority', 0))
+    matcher.compile()
+
+    writer = SnapshotWriter({
+        'version': digest.hexdigest()[:16],
+        'default': source['default'],
+        'sources': sources,
+    })
+    # Follow-ups of an intent get their own small automaton, so while a
+    # session waits for a follow-up only its candidates are matched
+    ids = {intent['name']: intent_id for intent_id, intent in enumerate(intents)}
+    writer.meta['follow_up_states'] = []
+    for intent_id, intent in enumerate(intents):
+        if not intent.get('follow_ups'):
+            continue
+        follow_ups = KeywordMatcher()
+        for follow_up in intent['follow_ups']:
+            if follow_up['intent'] not in ids:
+                raise ValueError(f"intent {intent['name']} follows up with unknown intent {follow_up['intent']}")
+            for keyword in follow_up['keywords']:
+                follow_ups.add(keyword, ids[follow_up['intent']])
+        follow_ups.compile()
+        follow_ups.to_snapshot(writer, f'follow_ups.{intent_id}.')
+        writer.meta['follow_up_states'].append(intent_id)
+
+    writer.add_strings('dictionary', sorted(words))
+    writer.add_strings('intent.names', [intent['name'] for intent in intents])
+    writer.add_strings('intent.responses', [intent['response'] for intent in intents])
+    writer.add_strings('intent.actions', [intent.get('action', '') for intent in intents])
+    matcher.to_snapshot(writer, 'matcher.')
+    FAQIndex.build(entries).to_snapshot(writer, 'faq.')
+    writer.write(snapshot_path)
+    return writer.meta['version']
+
+
+class KnowledgeBase:
+    """One immutable, memory-mapped version of the knowledge base."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.version = snapshot.meta['version']
+        self.default_response = snapshot.meta['default']
+        self.sources = snapshot.meta['sources']
+        self._names = snapshot.strings('intent.names')
+        self._responses = snapshot.strings('intent.responses')
+        self._actions = snapshot.strings('intent.actions')
+        # Words that are never corrected into a keyword, shared by all matchers
+        dictionary = snapshot.strings('dictionary') if 'dictionary' in snapshot else None
+        self.matcher = KeywordMatcher.from_snapshot(snapshot, 'matcher.', dictionary)
+        self.faq_index = FAQIndex.from_snapshot(snapshot, 'faq.')
+        self._follow_ups = {
+            intent_id: KeywordMatcher.from_snapshot(snapshot, f'follow_ups.{intent_id}.', dictionary)
+            for intent_id in snapshot.meta.get('follow_up_states', ())
+        }
+        self._states = {self._names[intent_id]: intent_id for intent_id in self._follow_ups}
+
+    @classmethod
+    def load(cls, path):
+        return cls(Snapshot(path))
+
+    def __len__(self):
+        return len(self._names)
+
+    def intent(self, intent_id):
+        return Intent(self._names[intent_id], self._responses[intent_id], self._actions[intent_id] or None)
+
+    def match(self, message):
+        """Return the highest-priority :class:`Intent` in ``message``, or None.
+
+        Intents with an action must be matched as spelled: a typo correction
+        alone never opens a ticket.
+        """
+        intent_id = self.matcher.match(message)
+        if intent_id is not None and self._actions[intent_id]:
+            intent_id = self.matcher.match(message, fuzzy=False)
+        return None if intent_id is None else self.intent(intent_id)
+
+    def faq_answer(self, message, min_confidence):
+        return self.faq_index.answer(message, min_confidence)
+
+    def answer(self, message, min_confidence):
+        """Resolve ``message`` to the :class:`Intent` that answers it.
+
+        Intents with an action win. A confident enough FAQ answer comes
+        next, but over a matched keyword only when its question also covers
+        most of the message, so "billing" or "invoice please" still get
+        their intents. Then the matched intent, then the default response.
+        """
+        intent = self.match(message)
+        if intent is not None and intent.action:
+            return intent
+        hit = self.faq_index.search(message, min_confidence)
+        if hit is not None and (intent is None or self.faq_index.covers(hit[0], message)):
+            return Intent('faq', self.faq_index.answers[hit[0]], None)
+        if intent is None:
+            # If no match found, suggest alternatives
+            return Intent('default', self.default_response, None)
+        return intent
+
+    def dialog_state(self, intent):
+        """The state answering with ``intent`` leaves a session in, or None.
+
+        A state is the id of an intent with follow-ups; the next message is
+        first matched against those follow-ups only.
+        """
+        return self._states.get(intent.name)
+
+    def follow_up(self, state, message):
+        """Return the follow-up :class:`Intent` of ``state`` in ``message``, or None."""
+        matcher = self._follow_ups.get(state)
+        intent_id = matcher.match(message) if matcher is not None else None
+        return None if intent_id is None else self.intent(intent_id)
+
+
+class KnowledgeBaseStore:
+    """Holds the current :class:`KnowledgeBase` and swaps in new versions.
+
+    At most every ``check_interval`` seconds one caller checks whether the
+    sources changed (recompiling the snapshot if ``auto_compile`` is set) or
+    another process wrote a new snapshot, and loads it. The swap is a single
+    reference assignment, so requests that already hold the previous version
+    finish with it while new requests see the new one.
+    """
+
+    def __init__(self, source_path, snapshot_path, check_interval=5.0, auto_compile=True):
+        self.source_path = source_path
+        self.snapshot_path = snapshot_path
+        self.check_interval = check_interval
+        self.auto_compile = auto_compile
+        self._kb = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        kb = self._kb
+        if kb is None:
+            with self._lock:
+                if self._kb is None:
+                    self._refresh()
+                return self._kb
+        if time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._refresh()
+            finally:
+                self._lock.release()
+            return self._kb
+        return kb
+
+    def reload(self):
+        """Check for a new version now and return the current one."""
+        with self._lock:
+            self._refresh()
+            return self._kb
+
+    def _stale(self):
+        try:
+            snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        sources = self._kb.sources if self._kb is not None else [self.source_path]
+        for path in sources:
+            try:
+                if os.stat(path).st_mtime_ns > snapshot_mtime:
+                    return True
+            except FileNotFoundError:
+                pass
+        return False
+
+    def _refresh(self):
+        self._next_check = time.monotonic() + self.check_interval
+        if self.auto_compile and self._stale():
+            try:
+                compile_snapshot(self.source_path, self.snapshot_path)
+            except (OSError, ValueError, KeyError):
+                if self._kb is None:
+                    raise
+                logger.exception('Failed to compile %s; keeping version %s', self.source_path, self._kb.version)
+                return
+
+        kb = self._kb
+        stat = os.stat(self.snapshot_path)
+        if kb is None or (stat.st_ino, stat.st_mtime_ns) != (kb.snapshot.stat.st_ino, kb.snapshot.stat.st_mtime_ns):
+            self._kb = KnowledgeBase.load(self.snapshot_path)
+            if kb is not None and kb.version != self._kb.version:
+                logger.info('Knowledge base updated from %s to %s', kb.version, self._kb.version)
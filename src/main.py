@@ -1,27 +1,222 @@
-from flask import Flask, render_template_string, request, jsonify, session
+from flask import Flask, Response, g, request, jsonify, session, stream_with_context, url_for
 try:
     from flask_sqlalchemy import SQLAlchemy
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.pool import StaticPool
 except Exception:
     SQLAlchemy = None
 
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import base64
+import click
+import functools
+import json
+import math
+import time
 import uuid
 import os
 import re
 
+from assets import StaticAsset
+from blobstore import BlobStore, OffsetMismatch, UploadTooLarge
+from cache import ResponseCache
+from dialog import DialogStates
+from events import EventBus, Subscription, parse_filters
+from export import FORMATS, export_stream
+from history import SessionHistory
+from jobs import JobRunner
+from knowledge import KnowledgeBaseStore, compile_snapshot
+from matcher import normalize
+from metrics import Registry
+from migrations import upgrade_schema
+from processing import extension_matches, process_upload
+from profiling import RequestProfiler
+from ratelimit import TokenBucketStore
+from replay import parse_line, replay
+from retention import ArchiveWriter, PeriodicTask, incremental_vacuum, remove_if_idle
+from storage import SQLITE_PRAGMAS, apply_sqlite_pragmas, database_uri, engine_options, normalize_database_uri
+from writebehind import WriteBehindQueue
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chatbot.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri('sqlite:///chatbot.db')  # override with DATABASE_URL
+# Per-process pool; sized for the chat threads of an ASGI worker plus the
+# background writer and job runner threads
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+app.config['SQLITE_PRAGMAS'] = SQLITE_PRAGMAS
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024  # bytes read from an upload at a time
+app.config['UPLOAD_MAX_SIZE'] = 512 * 1024 * 1024  # largest file a resumable upload may send
+app.config['UPLOAD_PROCESSING_IN_APP'] = True  # False leaves processing to `flask process-uploads`
+app.config['UPLOAD_PROCESSING_WORKERS'] = 2  # processes per runner for sniffing, thumbnails and text
+app.config['UPLOAD_PROCESSING_POLL_INTERVAL'] = 5.0  # seconds between checks for jobs queued elsewhere
+app.config['UPLOAD_JOB_TIMEOUT'] = 300  # seconds before a claimed job is presumed lost and retried
+app.config['UPLOAD_JOB_MAX_ATTEMPTS'] = 3
+app.config['UPLOAD_TEXT_LIMIT'] = 100000  # characters of extracted text kept per upload
+app.config['KNOWLEDGE_BASE_PATH'] = os.path.join(BASE_DIR, 'data', 'knowledge_base.json')
+app.config['KNOWLEDGE_BASE_SNAPSHOT'] = os.path.join(app.instance_path, 'knowledge_base.snap')
+app.config['KNOWLEDGE_BASE_RELOAD_INTERVAL'] = 5.0  # seconds between checks for new content
+app.config['FAQ_MIN_CONFIDENCE'] = 0.5  # BM25 score relative to the best possible score
+app.config['RESPONSE_CACHE_SIZE'] = 1024
+app.config['RESPONSE_CACHE_TTL'] = None  # seconds; None keeps entries until evicted
+app.config['CONVERSATION_WRITE_BEHIND'] = True  # batch conversation inserts off the request thread
+app.config['CONVERSATION_BATCH_SIZE'] = 100
+app.config['CONVERSATION_FLUSH_INTERVAL'] = 0.5  # seconds
+app.config['CONVERSATION_QUEUE_SIZE'] = 10000
+app.config['ADMIN_PAGE_SIZE'] = 100
+app.config['ADMIN_MAX_PAGE_SIZE'] = 500
+app.config['EXPORT_BATCH_SIZE'] = 1000  # rows fetched per round trip while exporting
+app.config['HISTORY_TURNS'] = 50  # turns kept per session for /history
+app.config['HISTORY_MAX_SESSIONS'] = 10000  # sessions kept in memory per worker
+app.config['HISTORY_TTL'] = 30.0  # seconds a buffered history is trusted before reloading
+app.config['CHAT_BATCH_MAX_MESSAGES'] = 100  # messages per /chat/batch request
+app.config['DIALOG_STATE_TTL'] = 300.0  # seconds a question's follow-ups stay open
+app.config['DIALOG_MAX_SESSIONS'] = 100000  # sessions with open follow-ups kept per worker
+app.config['HOME_PAGE_MAX_AGE'] = 24 * 60 * 60  # seconds browsers and proxies may cache the chat page
+app.config['ASGI_CHAT_THREADS'] = 8  # threads running chat turns for WebSocket clients (asgi.py)
+app.config['ASGI_HTTP_THREADS'] = 32  # threads serving HTTP requests to the Flask app (asgi.py)
+app.config['EVENT_RELAY_DIR'] = os.path.join(app.instance_path, 'events')  # None keeps events in-process
+app.config['EVENT_KEEPALIVE'] = 15.0  # seconds between keepalive comments on idle event streams
+app.config['EVENT_MAX_PENDING'] = 1000  # events buffered per subscriber before dropping
+app.config['METRICS_DIR'] = os.path.join(app.instance_path, 'metrics')  # None reports this process only
+app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')  # profiles and the slow request log
+app.config['PROFILE_SAMPLE_RATE'] = 0.0  # fraction of requests profiled from start to end
+app.config['PROFILE_SLOW_REQUEST_SECONDS'] = None  # requests still running after this are logged and profiled
+app.config['PROFILE_INTERVAL'] = 0.005  # seconds between stack samples of a profiled request
+app.config['PROFILE_MAX_FILES'] = 1000  # profile files kept; the oldest are removed
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'  # 0 for load tests
+app.config['RATE_LIMIT_FILE'] = os.path.join(app.instance_path, 'ratelimit.buckets')  # None limits per worker
+app.config['RETENTION_IN_APP'] = True  # False leaves retention to `flask retention`, e.g. from cron
+app.config['RETENTION_INTERVAL'] = 6 * 60 * 60  # seconds between runs; one worker runs each time
+# Days rows are kept; None keeps them forever. Conversations count from the
+# session's last message and stay while it has an open ticket; closed
+# tickets count from when they were opened. Rows are moved to ARCHIVE_DIR.
+app.config['RETENTION_POLICIES'] = {
+    'conversations': 90,
+    'tickets': 365,
+    'uploads': None,
+}
+app.config['RETENTION_BATCH_SIZE'] = 500  # rows per transaction, to keep write locks short
+app.config['RETENTION_PAUSE'] = 0.05  # seconds between batches, to let other writers in
+app.config['ARCHIVE_DIR'] = os.path.join(app.instance_path, 'archive')
+app.config['ORPHAN_BLOB_GRACE'] = 60 * 60  # seconds an unreferenced blob is left alone
+app.config['INCOMPLETE_UPLOAD_TTL'] = 7 * 24 * 60 * 60  # seconds before an abandoned upload is removed
+app.config['VACUUM_PAGES'] = 1000  # free pages returned per incremental vacuum step
+# (burst, refill per second) for each budget, per session and per client IP
+app.config['RATE_LIMITS'] = {
+    'chat': {'session': (20, 1.0), 'ip': (200, 10.0)},  # messages
+    'upload': {'session': (64 * 1024 * 1024, 1024 * 1024), 'ip': (256 * 1024 * 1024, 4 * 1024 * 1024)},  # bytes
+}
+
+# Any setting above can be overridden from the environment as CHATBOT_<NAME>,
+# e.g. CHATBOT_RESPONSE_CACHE_SIZE=4096; values are parsed as JSON if they can be.
+# These win over DATABASE_URL, DATABASE_POOL_SIZE and RATE_LIMIT_ENABLED.
+app.config.from_prefixed_env('CHATBOT')
+
+# Bound to the app by init_app(), so settings changed after import still apply
+db = SQLAlchemy() if SQLAlchemy is not None else None
+
+# Metrics served on /metrics, summed over all worker processes
+metrics = Registry()
+http_requests = metrics.counter('chatbot_http_requests_total', 'HTTP requests handled.', ('method', 'endpoint', 'status'))
+http_request_seconds = metrics.histogram(
+    'chatbot_http_request_duration_seconds', 'Time spent handling HTTP requests.', ('endpoint',)
+)
+stage_seconds = metrics.histogram(
+    'chatbot_stage_duration_seconds', 'Time spent in each stage of handling a request.', ('stage',)
+)
+chat_responses = metrics.counter('chatbot_chat_responses_total', 'Chat messages answered, by intent.', ('intent',))
+cache_lookups = metrics.counter('chatbot_response_cache_lookups_total', 'Response cache lookups, by result.', ('result',))
+tickets_created = metrics.counter('chatbot_support_tickets_created_total', 'Support tickets opened.')
+uploads_received = metrics.counter(
+    'chatbot_uploads_total', 'Files uploaded; deduplicated ones reuse a stored blob.', ('deduplicated',)
+)
+upload_bytes = metrics.counter('chatbot_upload_bytes_total', 'Bytes received in uploaded files.')
+rate_limited = metrics.counter('chatbot_rate_limited_total', 'Requests refused by the rate limiter.', ('budget',))
+
+# Opt-in profiling of sampled and slow requests, listed on /admin/slow-requests
+profiler = RequestProfiler()
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stage_seconds.labels(stage).observe(seconds)
+        profiler.add_stage(stage, seconds)
+
+@app.before_request
+def start_request_timer():
+    metrics.ensure_started()
+    g.request_started = time.perf_counter()
+    if profiler.enabled:
+        profiler.start(request.method, request.path)
+
+@app.after_request
+def record_request_metrics(response):
+    # Each proxy lookup costs about a microsecond; resolve them once
+    started = g._get_current_object().pop('request_started', None)
+    current = request._get_current_object()
+    endpoint = current.url_rule.rule if current.url_rule is not None else 'unmatched'
+    if started is not None:
+        http_request_seconds.labels(endpoint).observe(time.perf_counter() - started)
+        http_requests.labels(current.method, endpoint, response.status_code).inc()
+    profile = profiler.current()
+    if profile is not None:
+        profiler.finish(profile, endpoint, response.status_code)
+    return response
 
-db = SQLAlchemy(app) if SQLAlchemy is not None else None
+@app.teardown_request
+def finish_failed_profile(exc):
+    # Requests that raised never reach record_request_metrics
+    profile = profiler.current()
+    if profile is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        profiler.finish(profile, endpoint, 500)
+
+if db is not None:
+    # Every commit, including the batched conversation inserts, is timed
+    @event.listens_for(db.session, 'before_commit')
+    def start_commit_timer(db_session):
+        db_session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(db.session, 'after_commit')
+    def record_commit_time(db_session):
+        started = db_session.info.pop('commit_started', None)
+        if started is not None:
+            seconds = time.perf_counter() - started
+            stage_seconds.labels('db_commit').observe(seconds)
+            profiler.add_stage('db_commit', seconds)
+
+    # Statements of profiled requests are timed; others only pay the check
+    def start_statement_timer(connection, cursor, statement, parameters, context, executemany):
+        if context is not None and profiler.current() is not None:
+            context.profile_started = time.perf_counter()
+
+    def record_statement_time(connection, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'profile_started', None)
+        if started is not None:
+            profiler.add_statement(statement, time.perf_counter() - started)
 
 # Database Models
 if db is not None:
     class Conversation(db.Model):
+        __table_args__ = (
+            db.Index('ix_conversation_session_timestamp', 'session_id', 'timestamp'),
+            db.Index('ix_conversation_timestamp_id', 'timestamp', 'id'),
+        )
+
         id = db.Column(db.Integer, primary_key=True)
         session_id = db.Column(db.String(100), nullable=False)
         message = db.Column(db.Text, nullable=False)
@@ -30,6 +225,14 @@ if db is not None:
         user_type = db.Column(db.String(20), default='user')  # 'user' or 'agent'
 
     class SupportTicket(db.Model):
+        # At most one ticket per session may be open at a time
+        __table_args__ = (
+            # Partial on the databases that support it; see add_open_ticket_clause()
+            db.Index('uq_support_ticket_open_session', 'session_id', unique=True),
+            db.Index('ix_support_ticket_status_priority_created', 'status', 'priority', 'created_at'),
+            db.Index('ix_support_ticket_created_id', 'created_at', 'id'),
+        )
+
         id = db.Column(db.Integer, primary_key=True)
         session_id = db.Column(db.String(100), nullable=False)
         status = db.Column(db.String(20), default='open')  # 'open', 'assigned', 'closed'
@@ -40,9 +243,64 @@ if db is not None:
     class UploadedFile(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         session_id = db.Column(db.String(100), nullable=False)
-        filename = db.Column(db.String(200), nullable=False)
+        filename = db.Column(db.String(200), nullable=False)  # blob name, shared by identical files
         original_filename = db.Column(db.String(200), nullable=False)
         upload_time = db.Column(db.DateTime, default=datetime.utcnow)
+        content_hash = db.Column(db.String(64), index=True)  # hex SHA-256 of the content
+        size = db.Column(db.Integer)
+        # Filled in by the upload processing jobs
+        processing_status = db.Column(db.String(20), default='pending')  # 'pending', 'done', 'rejected', 'failed'
+        mime_type = db.Column(db.String(100))  # type found in the content
+        thumbnail = db.Column(db.String(200))  # blob store name of the thumbnail
+        extracted_text = db.Column(db.Text)
+
+    class UploadJob(db.Model):
+        __table_args__ = (
+            db.Index('ix_upload_job_status_id', 'status', 'id'),
+        )
+
+        id = db.Column(db.Integer, primary_key=True)
+        upload_id = db.Column(db.Integer, db.ForeignKey('uploaded_file.id'), nullable=False)
+        status = db.Column(db.String(20), default='queued')  # 'queued', 'running', 'done', 'failed'
+        attempts = db.Column(db.Integer, default=0)
+        created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        started_at = db.Column(db.DateTime)
+        error = db.Column(db.Text)
+
+    open_ticket_index = next(i for i in SupportTicket.__table__.indexes if i.name == 'uq_support_ticket_open_session')
+
+    def add_open_ticket_clause(dialect_name):
+        """Limit the one-ticket-per-session index to open tickets on ``dialect_name``.
+
+        Naming a dialect's options imports that dialect, and PostgreSQL's
+        alone took a quarter of startup, so only dialects in use get it.
+        Other dialects have no partial indexes, and a plain unique index
+        would stop a session from ever opening a second ticket, so there
+        the index is dropped from the model and only the lookup in
+        create_support_ticket() keeps tickets apart.
+        """
+        if dialect_name in ('sqlite', 'postgresql'):
+            open_ticket_index.dialect_options[dialect_name]['where'] = db.text("status != 'closed'")
+        else:
+            SupportTicket.__table__.indexes.discard(open_ticket_index)
+
+    def close_duplicate_open_tickets(connection):
+        """Leave only the oldest open ticket of each session open.
+
+        Databases from before the one-open-ticket index may hold several;
+        the index cannot be created until they are closed.
+        """
+        table = SupportTicket.__table__
+        still_open = table.c.status != 'closed'
+        oldest = db.select(db.func.min(table.c.id)).where(still_open).group_by(table.c.session_id)
+        closed = connection.execute(
+            db.update(table).where(still_open, table.c.id.not_in(oldest)).values(status='closed')
+        ).rowcount
+        if closed:
+            app.logger.warning('Closed %d duplicate open tickets before adding the one-open-ticket index', closed)
+
+    # Run before creating these indexes on a database that predates them
+    INDEX_UPGRADES = {'uq_support_ticket_open_session': close_duplicate_open_tickets}
 else:
     # Lightweight fallbacks so module can be imported without SQLAlchemy
     class Conversation:
@@ -57,436 +315,1002 @@ else:
         def __init__(self, *args, **kwargs):
             pass
 
-# Enhanced response system with categories
-responses = {
-    # Greetings
-    "hello": "Hi there! Welcome to our support center. How can I assist you today?",
-    "hi": "Hello! I'm here to help with any questions you have.",
-    
-    # Billing Support
-    "billing": "I can help with billing questions. Are you looking for invoice details, payment issues, or subscription changes?",
-    "payment": "For payment issues, I can help you with: \n• Payment methods\n• Failed payments\n• Refund requests\n• Billing address updates",
-    "refund": "I understand you'd like a refund. Let me connect you with our billing specialist who can review your account.",
-    "invoice": "You can find your invoices in your account dashboard. Would you like me to guide you there?",
-    
-    # Technical Support
-    "technical": "I'm here for technical support! What specific issue are you experiencing?",
-    "bug": "Sorry to hear about the technical issue. Can you describe what happened? Feel free to upload screenshots if helpful.",
-    "error": "Let's troubleshoot this error together. What error message are you seeing?",
-    "login": "Having trouble logging in? Try: \n• Reset your password\n• Clear browser cache\n• Check your email for verification\n• Contact us if issues persist",
-    
-    # Account Help
-    "account": "I can help with account-related questions including profile updates, security settings, and access issues.",
-    "password": "To reset your password, click 'Forgot Password' on the login page. Check your email for reset instructions.",
-    "profile": "You can update your profile information in Account Settings. Need help finding it?",
-    
-    # General Support
-    "help": "I'm here to help! I can assist with:\n• Billing and payments\n• Technical issues\n• Account management\n• General questions\n\nWhat would you like help with?",
-    "human": "I'll connect you with a human agent right away. Please hold on.",
-    "agent": "Transferring you to our live support team. An agent will be with you shortly.",
-    
-    # Farewells
-    "bye": "Thank you for contacting support! Have a great day and don't hesitate to reach out if you need more help.",
-    "thanks": "You're welcome! Is there anything else I can help you with today?",
-    
-    # File upload responses
-    "upload": "Great! I can see you've uploaded a file. This will help our team assist you better.",
-    
-    # Default
-    "default": "I'm not sure I understand. Could you please rephrase that? Or type 'help' to see what I can assist with."
-}
+    class UploadJob:
+        def __init__(self, *args, **kwargs):
+            pass
 
-# FAQ responses
-faq_responses = {
-    "how to cancel": "To cancel your subscription, go to Account Settings > Billing > Cancel Subscription. You'll retain access until your current period ends.",
-    "supported browsers": "We support Chrome, Firefox, Safari, and Edge (latest versions). Internet Explorer is not supported.",
-    "data security": "Your data is encrypted and stored securely. We're SOC 2 compliant and follow industry best practices for data protection.",
-    "contact hours": "Our support team is available Monday-Friday 9AM-6PM EST. Premium users have 24/7 access."
+# Tables available for export, with the column their time range applies to
+EXPORT_TABLES = {
+    'conversations': (Conversation, 'timestamp'),
+    'tickets': (SupportTicket, 'created_at'),
+    'uploads': (UploadedFile, 'upload_time'),
 }
 
+# Intents and FAQ content live in data/knowledge_base.json and are served
+# from a memory-mapped snapshot that is reloaded when the content changes
+knowledge_base = KnowledgeBaseStore(
+    app.config['KNOWLEDGE_BASE_PATH'],
+    app.config['KNOWLEDGE_BASE_SNAPSHOT'],
+    check_interval=app.config['KNOWLEDGE_BASE_RELOAD_INTERVAL'],
+)
+
+# Answers keyed on normalized message text; the home page quick actions
+# send the same few messages over and over
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+
 def create_tables():
     with app.app_context():
         if db is not None:
-            db.create_all()
+            # Also adds columns and indexes that databases created by older versions lack
+            upgrade_schema(db.engine, db.metadata, INDEX_UPGRADES)
         # Create upload directory
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+def init_app(app):
+    """Set up the database engine and the subsystems from ``app.config``.
+
+    Nothing reads these settings or opens the database before this runs,
+    so they can still be changed after import. Only the first call counts.
+    """
+    if 'chatbot' in app.extensions:
+        return
+    app.extensions['chatbot'] = True
+    metrics.configure(app.config['METRICS_DIR'])
+    profiler.configure(
+        app.config['PROFILE_DIR'],
+        sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+        slow_seconds=app.config['PROFILE_SLOW_REQUEST_SECONDS'],
+        interval=app.config['PROFILE_INTERVAL'],
+        max_files=app.config['PROFILE_MAX_FILES'],
+    )
+    event_bus.configure(app.config['EVENT_RELAY_DIR'])
+    conversation_writer.configure(
+        batch_size=app.config['CONVERSATION_BATCH_SIZE'],
+        flush_interval=app.config['CONVERSATION_FLUSH_INTERVAL'],
+        max_size=app.config['CONVERSATION_QUEUE_SIZE'],
+    )
+    if db is None:
+        return
+    app.config['SQLALCHEMY_DATABASE_URI'] = normalize_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+    # Derived from the final URI, as in-memory SQLite takes no pool options
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], pool_size=app.config['DATABASE_POOL_SIZE']
+    ))
+    db.init_app(app)
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+        add_open_ticket_clause(db.engine.dialect.name)
+        event.listen(db.engine, 'before_cursor_execute', start_statement_timer)
+        event.listen(db.engine, 'after_cursor_execute', record_statement_time)
+
+def create_app():
+    """Return the app ready to serve, with its tables created and content loaded.
+
+    Servers call this once before forking workers (``gunicorn --preload``),
+    so the knowledge base is loaded once and shared copy-on-write by every
+    worker. Safe to call again.
+    """
+    init_app(app)
+    create_tables()
+    knowledge_base.current()
+    if db is not None:
+        with app.app_context():
+            # Pooled connections must not be inherited by forked workers; an
+            # in-memory database only lives as long as its one connection
+            if not isinstance(db.engine.pool, StaticPool):
+                db.engine.dispose()
+    return app
+
+def cli_command(name):
+    """Register a ``flask`` command that sets the app up with init_app() first.
+
+    ``flask --app src/main.py`` loads the module's app without going through
+    create_app(), so the commands bind the database themselves.
+    """
+    def register(f):
+        @functools.wraps(f)
+        def command(*args, **kwargs):
+            init_app(app)
+            return f(*args, **kwargs)
+        return app.cli.command(name)(command)
+    return register
+
 def get_session_id():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
     return session['session_id']
 
+def write_conversations(rows):
+    """Insert queued conversation rows with one multi-row INSERT."""
+    with app.app_context():
+        db.session.execute(db.insert(Conversation), rows)
+        db.session.commit()
+
+conversation_writer = WriteBehindQueue(write_conversations)
+
+# Ticket and message events for agents, shared by all workers on the host
+event_bus = EventBus()
+
+# Which answer's follow-ups each session is in the middle of
+dialog_states = DialogStates(app.config['DIALOG_MAX_SESSIONS'], app.config['DIALOG_STATE_TTL'])
+
+# Recent turns of active sessions, served by /history
+session_history = SessionHistory(
+    app.config['HISTORY_TURNS'], app.config['HISTORY_MAX_SESSIONS'], app.config['HISTORY_TTL']
+)
+
+def history_turn(message, response, timestamp, user_type):
+    return {'message': message, 'response': response, 'timestamp': timestamp.isoformat(), 'user_type': user_type}
+
+def load_session_history(session_id):
+    """Read a session's latest turns from the database into the history buffer."""
+    if db is None:
+        return []
+    conversation_writer.flush()
+    rows = db.session.execute(
+        db.select(Conversation)
+        .where(Conversation.session_id == session_id)
+        .order_by(Conversation.timestamp.desc(), Conversation.id.desc())
+        .limit(app.config['HISTORY_TURNS'])
+    ).scalars().all()
+    turns = [history_turn(c.message, c.response, c.timestamp, c.user_type) for c in reversed(rows)]
+    session_history.load(session_id, turns)
+    return turns
+
 def save_conversation(message, response, session_id, user_type='user'):
     if db is None:
         return
+    timestamp = datetime.utcnow()
+    turn = history_turn(message, response, timestamp, user_type)
+    session_history.append(session_id, turn)
+    event_bus.publish('message', dict(turn, session_id=session_id))
+    if app.config['CONVERSATION_WRITE_BEHIND']:
+        conversation_writer.put({
+            'session_id': session_id,
+            'message': message,
+            'response': response,
+            'user_type': user_type,
+            'timestamp': timestamp,
+        })
+        return
     conversation = Conversation(
         session_id=session_id,
         message=message,
         response=response,
+        timestamp=timestamp,
         user_type=user_type
     )
     db.session.add(conversation)
     db.session.commit()
 
+def match_message(message):
+    """Resolve a message to the Intent that answers it, without side effects."""
+    kb = knowledge_base.current()
+    # Matching only looks at normalized tokens, so they make a safe cache key
+    key = ' '.join(normalize(message))
+    intent = response_cache.get(kb.version, key)
+    if intent is not None:
+        cache_lookups.labels('hit').inc()
+        return intent
+    cache_lookups.labels('miss').inc()
+
+    intent = kb.answer(message, app.config['FAQ_MIN_CONFIDENCE'])
+    if intent.action:
+        # Intents with actions must run them every time, so they are never cached
+        return intent
+
+    response_cache.put(kb.version, key, intent)
+    return intent
+
+# Outcome of handling one chat message
+Reply = namedtuple('Reply', 'intent response ticket_id ticket_created')
+
+def handle_message(message, session_id):
+    """Answer a message and run the side effects of its intent."""
+    with timed_stage('respond'):
+        kb = knowledge_base.current()
+        intent = None
+        state = dialog_states.get(session_id, kb.version)
+        if state is not None:
+            # Only the follow-ups of the current topic are candidates; not
+            # cached, as the same words mean different things in different topics
+            intent = kb.follow_up(state, message)
+        if intent is not None:
+            # Stay on the topic unless the follow-up opens one of its own
+            next_state = kb.dialog_state(intent)
+            if next_state is None:
+                next_state = state
+        else:
+            intent = match_message(message)
+            # Only the answer the user saw opens a topic; FAQ answers have none
+            next_state = kb.dialog_state(intent)
+        dialog_states.set(session_id, kb.version, next_state)
+        ticket_id, ticket_created = None, False
+
+        # Check for live agent requests
+        if intent.action == 'create_ticket':
+            ticket_id, ticket_created = create_support_ticket(session_id, 'high')
+
+    chat_responses.labels(intent.name).inc()
+    return Reply(intent.name, intent.response, ticket_id, ticket_created)
+
 def get_response(message, session_id):
-    message_lower = message.lower()
-    
-    # Check for live agent requests
-    if any(word in message_lower for word in ['human', 'agent', 'live chat', 'speak to someone']):
-        create_support_ticket(session_id, 'high')
-        return "I'm connecting you with a live agent now. Please hold on while I transfer your chat."
-    
-    # Check FAQ first
-    for faq_key, faq_response in faq_responses.items():
-        if faq_key in message_lower:
-            return faq_response
-    
-    # Check regular responses
-    for key, response in responses.items():
-        if key in message_lower:
-            return response
-    
-    # If no match found, suggest alternatives
-    return responses["default"] + "\n\nPopular topics: billing, technical support, account help, or type 'human' for live chat."
+    return handle_message(message, session_id).response
+
+# Token buckets shared by all workers
+rate_limiter = TokenBucketStore(app.config['RATE_LIMIT_FILE'])
+
+def rate_limit_wait(budget, session_id, client_ip, cost=1, force=False):
+    """Spend ``cost`` from the caller's ``budget`` for their session and IP.
+
+    Returns 0 if allowed, or else the seconds to wait. ``force`` charges
+    the cost without refusing, for sizes only known after the fact.
+    """
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return 0
+    limits = app.config['RATE_LIMITS'][budget]
+    # Charged together, so a request refused for its IP costs its session nothing
+    buckets = [
+        (f'{budget}:{scope}:{key}', *limits[scope]) for scope, key in (('session', session_id), ('ip', client_ip))
+    ]
+    wait = rate_limiter.take_all(buckets, cost, force)
+    if wait:
+        rate_limited.labels(budget).inc()
+    return wait
+
+def too_many_requests(wait):
+    response = jsonify({'success': False, 'error': 'Too many requests, slow down', 'retry_after': math.ceil(wait)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+def chat_turn(message, session_id):
+    """Answer and record one chat message; shared by /chat and the WebSocket."""
+    reply = handle_message(message, session_id)
+
+    # Save conversation to database
+    save_conversation(message, reply.response, session_id)
+
+    response_data = {'response': reply.response}
+    if reply.ticket_id is not None:
+        response_data['ticket_created'] = reply.ticket_created
+        response_data['ticket_id'] = reply.ticket_id
+    return response_data
+
+def find_open_ticket_id(session_id):
+    return db.session.execute(
+        db.select(SupportTicket.id)
+        .where(SupportTicket.session_id == session_id, SupportTicket.status != 'closed')
+    ).scalar()
 
 def create_support_ticket(session_id, priority='medium'):
+    """Open a ticket for the session unless it already has an open one.
+
+    Returns ``(ticket_id, created)``. On SQLite and PostgreSQL the unique
+    index on open tickets makes this safe when several workers handle the
+    same session at once.
+    """
     if db is None:
-        return None
+        return None, False
+    ticket_id = find_open_ticket_id(session_id)
+    if ticket_id is not None:
+        return ticket_id, False
     ticket = SupportTicket(
         session_id=session_id,
         priority=priority
     )
     db.session.add(ticket)
-    db.session.commit()
-    return ticket.id
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request opened the ticket first
+        db.session.rollback()
+        return find_open_ticket_id(session_id), False
+    tickets_created.inc()
+    event_bus.publish('ticket.created', ticket_to_dict(ticket))
+    return ticket.id, True
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+chat_page = StaticAsset(os.path.join(app.static_folder, 'chat.html'), 'text/html')
+
 @app.route('/')
 def home():
-    session_id = get_session_id()
-    return render_template_string('''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Support Center - Live Chat</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        * { box-sizing: border-box; }
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-            margin: 0; padding: 20px; background: #f5f5f5;
-        }
-        .chat-container {
-            max-width: 600px; margin: 0 auto; background: white;
-            border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            overflow: hidden;
-        }
-        .chat-header {
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white; padding: 20px; text-align: center;
-        }
-        .status-indicator {
-            display: inline-block; width: 10px; height: 10px;
-            background: #4CAF50; border-radius: 50%; margin-right: 8px;
-        }
-        #chat {
-            height: 400px; overflow-y: auto; padding: 20px;
-            background: white;
-        }
-        .message {
-            margin: 10px 0; padding: 10px 15px;
-            border-radius: 18px; max-width: 80%;
-            word-wrap: break-word;
-        }
-        .user-message {
-            background: #007AFF; color: white;
-            margin-left: auto; text-align: right;
-        }
-        .bot-message {
-            background: #f1f1f1; color: #333;
-            border: 1px solid #e1e1e1;
-        }
-        .input-container {
-            padding: 20px; background: #fafafa;
-            border-top: 1px solid #e1e1e1;
-        }
-        .input-row {
-            display: flex; gap: 10px; align-items: center;
-        }
-        #message {
-            flex: 1; padding: 12px 16px; border: 2px solid #e1e1e1;
-            border-radius: 25px; outline: none; font-size: 14px;
-        }
-        #message:focus { border-color: #007AFF; }
-        button {
-            padding: 12px 20px; background: #007AFF; color: white;
-            border: none; border-radius: 20px; cursor: pointer;
-            font-weight: 600; transition: all 0.3s;
-        }
-        button:hover { background: #0056CC; transform: translateY(-1px); }
-        .file-upload {
-            display: flex; align-items: center; gap: 10px;
-            margin-top: 10px;
-        }
-        .file-input {
-            display: none;
-        }
-        .file-button {
-            background: #34C759; padding: 8px 16px;
-            font-size: 12px;
-        }
-        .quick-actions {
-            display: flex; gap: 8px; margin-top: 10px;
-            flex-wrap: wrap;
-        }
-        .quick-btn {
-            background: #f0f0f0; color: #333;
-            border: 1px solid #ddd; padding: 6px 12px;
-            font-size: 12px; border-radius: 15px;
-        }
-        .quick-btn:hover { background: #e0e0e0; }
-        .typing-indicator {
-            display: none; padding: 10px; font-style: italic;
-            color: #666;
-        }
-    </style>
-</head>
-<body>
-    <div class="chat-container">
-        <div class="chat-header">
-            <h1><span class="status-indicator"></span>Support Center</h1>
-            <p>We're here to help! Average response time: 2 minutes</p>
-        </div>
-        
-        <div id="chat">
-            <div class="message bot-message">
-                Welcome! I'm your support assistant. I can help with billing, technical issues, account questions, and more. How can I assist you today?
-            </div>
-        </div>
-        
-        <div class="typing-indicator" id="typing">Support is typing...</div>
-        
-        <div class="input-container">
-            <div class="input-row">
-                <input type="text" id="message" placeholder="Type your message..." onkeypress="handleKeyPress(event)">
-                <button onclick="sendMessage()">Send</button>
-            </div>
-            
-            <div class="file-upload">
-                <input type="file" id="fileInput" class="file-input" onchange="uploadFile()" accept=".txt,.pdf,.png,.jpg,.jpeg,.gif,.doc,.docx">
-                <button class="file-button" onclick="document.getElementById('fileInput').click()">📎 Upload File</button>
-                <span id="fileStatus"></span>
-            </div>
-            
-            <div class="quick-actions">
-                <button class="quick-btn" onclick="quickMessage('billing help')">💳 Billing</button>
-                <button class="quick-btn" onclick="quickMessage('technical support')">🔧 Technical</button>
-                <button class="quick-btn" onclick="quickMessage('account help')">👤 Account</button>
-                <button class="quick-btn" onclick="quickMessage('human agent')">💬 Live Chat</button>
-            </div>
-        </div>
-    </div>
-
-    <script>
-        let isUploading = false;
-        
-        function handleKeyPress(event) {
-            if (event.key === 'Enter') {
-                sendMessage();
-            }
-        }
-        
-        function quickMessage(message) {
-            document.getElementById('message').value = message;
-            sendMessage();
-        }
-        
-        function sendMessage() {
-            const messageInput = document.getElementById('message');
-            const message = messageInput.value.trim();
-            if (message === '' || isUploading) return;
-
-            addMessage(message, 'user');
-            messageInput.value = '';
-            showTyping();
-
-            fetch('/chat', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ message: message })
-            })
-            .then(response => response.json())
-            .then(data => {
-                hideTyping();
-                addMessage(data.response, 'bot');
-                if (data.ticket_created) {
-                    addMessage('✅ Support ticket #' + data.ticket_id + ' created. An agent will join this chat shortly.', 'system');
-                }
-            })
-            .catch(error => {
-                hideTyping();
-                addMessage('Sorry, there was an error. Please try again.', 'bot');
-            });
-        }
-        
-        function uploadFile() {
-            const fileInput = document.getElementById('fileInput');
-            const file = fileInput.files[0];
-            if (!file) return;
-            
-            isUploading = true;
-            const fileStatus = document.getElementById('fileStatus');
-            fileStatus.textContent = 'Uploading...';
-            
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            fetch('/upload', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
-            .then(data => {
-                isUploading = false;
-                if (data.success) {
-                    fileStatus.textContent = '✅ ' + file.name + ' uploaded';
-                    addMessage('📎 Uploaded: ' + file.name, 'user');
-                    addMessage(data.message, 'bot');
-                } else {
-                    fileStatus.textContent = '❌ Upload failed';
-                    addMessage('Sorry, file upload failed. ' + data.error, 'bot');
-                }
-                fileInput.value = '';
-            })
-            .catch(error => {
-                isUploading = false;
-                fileStatus.textContent = '❌ Upload error';
-                addMessage('File upload error. Please try again.', 'bot');
-                fileInput.value = '';
-            });
-        }
-        
-        function showTyping() {
-            document.getElementById('typing').style.display = 'block';
-        }
-        
-        function hideTyping() {
-            document.getElementById('typing').style.display = 'none';
-        }
-
-        function addMessage(message, type) {
-            const chat = document.getElementById('chat');
-            const messageDiv = document.createElement('div');
-            messageDiv.className = 'message ' + (type === 'user' ? 'user-message' : 'bot-message');
-            
-            // Convert newlines to HTML breaks
-            const formattedMessage = message.replace(/\n/g, '<br>');
-            messageDiv.innerHTML = formattedMessage;
-            
-            chat.appendChild(messageDiv);
-            chat.scrollTop = chat.scrollHeight;
-        }
-        
-        // Auto-focus message input
-        document.getElementById('message').focus();
-    </script>
-</body>
-</html>
-    ''')
+    # The page is identical for every visitor, so it is served pre-rendered and
+    # precompressed; the chat session is created by the first /chat request
+    with timed_stage('page'):
+        return chat_page.response(request, app.config['HOME_PAGE_MAX_AGE'])
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
 
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.get_json()
     message = data.get('message', '')
     session_id = get_session_id()
-    
-    response = get_response(message, session_id)
-    
-    # Save conversation to database
-    save_conversation(message, response, session_id)
-    
-    # Check if a support ticket was created
-    ticket_created = 'connecting you with a live agent' in response.lower()
-    
-    response_data = {'response': response}
-    if ticket_created:
-        ticket_id = create_support_ticket(session_id, 'high')
-        response_data['ticket_created'] = True
-        response_data['ticket_id'] = ticket_id
-    
-    return jsonify(response_data)
+    wait = rate_limit_wait('chat', session_id, request.remote_addr)
+    if wait:
+        return too_many_requests(wait)
+    return jsonify(chat_turn(message, session_id))
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Answer ``{"messages": [...]}`` in order, as if each was sent to /chat."""
+    data = request.get_json(silent=True) or {}
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not all(isinstance(m, str) for m in messages):
+        return jsonify({'error': 'messages must be a list of strings'}), 400
+    if len(messages) > app.config['CHAT_BATCH_MAX_MESSAGES']:
+        return jsonify({'error': f"at most {app.config['CHAT_BATCH_MAX_MESSAGES']} messages per batch"}), 413
+    session_id = get_session_id()
+    wait = rate_limit_wait('chat', session_id, request.remote_addr, len(messages))
+    if wait:
+        return too_many_requests(wait)
+    return jsonify({'responses': [chat_turn(message, session_id) for message in messages]})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Counters and histograms of every worker, in the Prometheus text format."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/history')
+def history():
+    """Return the latest turns of the caller's chat session, oldest first."""
+    if 'session_id' not in session:
+        return jsonify([])
+    session_id = session['session_id']
+    limit = min(request.args.get('limit', app.config['HISTORY_TURNS'], type=int), app.config['HISTORY_TURNS'])
+    turns = session_history.get(session_id)
+    if turns is None:
+        turns = load_session_history(session_id)
+    return jsonify(turns[-limit:] if limit > 0 else [])
+
+def upload_store():
+    return BlobStore(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_CHUNK_SIZE'])
+
+def copy_processing_results(uploaded_file):
+    """Reuse the results of an earlier upload of the same content, if any."""
+    earlier = db.session.execute(
+        db.select(UploadedFile)
+        .where(UploadedFile.content_hash == uploaded_file.content_hash, UploadedFile.mime_type.is_not(None))
+        .limit(1)
+    ).scalar()
+    if earlier is None:
+        return False
+    apply_processing_result(uploaded_file, {
+        'mime_type': earlier.mime_type,
+        'thumbnail': earlier.thumbnail is not None,
+        'text': earlier.extracted_text,
+    })
+    return True
+
+def apply_processing_result(uploaded_file, result):
+    uploaded_file.mime_type = result['mime_type']
+    uploaded_file.thumbnail = upload_store().thumbnail_name(uploaded_file.content_hash) if result['thumbnail'] else None
+    uploaded_file.extracted_text = result['text']
+    # The extension only passed allowed_file; the content must agree with it
+    matches = extension_matches(uploaded_file.original_filename, result['mime_type'])
+    uploaded_file.processing_status = 'done' if matches else 'rejected'
+
+def record_upload(session_id, filename, blob):
+    """Point a new UploadedFile row at a stored blob and build the reply.
+
+    Processing is queued in the same transaction and runs in the
+    background, so the reply never waits for it.
+    """
+    name, digest, size, created = blob
+    uploads_received.labels('false' if created else 'true').inc()
+    upload_bytes.inc(size)
+    if db is not None:
+        uploaded_file = UploadedFile(
+            session_id=session_id,
+            filename=name,
+            original_filename=filename,
+            content_hash=digest,
+            size=size
+        )
+        db.session.add(uploaded_file)
+        queued = created or not copy_processing_results(uploaded_file)
+        if queued:
+            db.session.flush()
+            db.session.add(UploadJob(upload_id=uploaded_file.id))
+        db.session.commit()
+        if queued and app.config['UPLOAD_PROCESSING_IN_APP']:
+            upload_processor.notify()
+    return {
+        'success': True,
+        'message': (
+            f"Thanks for uploading {filename}! I've received your file and "
+            "our support team can now review it to better assist you."
+        ),
+    }
+
+def claim_upload_jobs(limit):
+    """Mark up to ``limit`` queued jobs as running and return their arguments."""
+    with app.app_context():
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=app.config['UPLOAD_JOB_TIMEOUT'])
+        max_attempts = app.config['UPLOAD_JOB_MAX_ATTEMPTS']
+        # Jobs whose runner died are retried until they run out of attempts
+        claimable = (
+            db.select(UploadJob.id)
+            .where(
+                db.or_(UploadJob.status == 'queued', db.and_(UploadJob.status == 'running', UploadJob.started_at < stale)),
+                UploadJob.attempts < max_attempts,
+            )
+            .order_by(UploadJob.id)
+            .limit(limit)
+        )
+        claimed = db.session.execute(
+            db.update(UploadJob)
+            .where(UploadJob.id.in_(claimable))
+            .values(status='running', started_at=now, attempts=UploadJob.attempts + 1)
+            .returning(UploadJob.id, UploadJob.upload_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.execute(
+            db.update(UploadJob)
+            .where(UploadJob.status == 'running', UploadJob.started_at < stale, UploadJob.attempts >= max_attempts)
+            .values(status='failed', error='timed out')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        store = upload_store()
+        jobs = []
+        for job_id, upload_id in claimed:
+            uploaded_file = db.session.get(UploadedFile, upload_id)
+            args = (
+                store.path(uploaded_file.filename),
+                store.path(store.thumbnail_name(uploaded_file.content_hash)),
+                app.config['UPLOAD_TEXT_LIMIT'],
+            )
+            jobs.append((job_id, args))
+        return jobs
+
+def complete_upload_job(job_id, result, error):
+    with app.app_context():
+        job = db.session.get(UploadJob, job_id)
+        uploaded_file = db.session.get(UploadedFile, job.upload_id)
+        if error is None:
+            apply_processing_result(uploaded_file, result)
+            job.status = 'done'
+        elif job.attempts < app.config['UPLOAD_JOB_MAX_ATTEMPTS']:
+            job.status = 'queued'
+        else:
+            job.status = 'failed'
+            uploaded_file.processing_status = 'failed'
+        job.error = error
+        db.session.commit()
+
+# Sniffs, thumbnails and extracts text from new uploads on a process pool
+upload_processor = JobRunner(
+    process_upload,
+    claim_upload_jobs,
+    complete_upload_job,
+    workers=app.config['UPLOAD_PROCESSING_WORKERS'],
+    poll_interval=app.config['UPLOAD_PROCESSING_POLL_INTERVAL'],
+)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    """Store an uploaded file, sent as multipart form data or as the raw body.
+
+    A raw body (``POST /upload?filename=...``) is hashed and written in
+    chunks straight off the request stream without being spooled first.
+    """
     session_id = get_session_id()
-    
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'error': 'No file selected'})
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'No file selected'})
-    
-    if file and allowed_file(file.filename):
-        # Generate secure filename
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        
-        try:
-            file.save(filepath)
-            
-            # Save file info to database (if available)
-            if db is not None:
-                uploaded_file = UploadedFile(
-                    session_id=session_id,
-                    filename=unique_filename,
-                    original_filename=filename
-                )
-                db.session.add(uploaded_file)
-                db.session.commit()
-            
-            return jsonify({
-                'success': True, 
-                'message': f"Thanks for uploading {filename}! I've received your file and our support team can now review it to better assist you."
-            })
-            
-        except Exception as e:
-            return jsonify({'success': False, 'error': 'File upload failed'})
-    
-    return jsonify({'success': False, 'error': 'File type not allowed'})
 
-@app.route('/admin/conversations')
-def admin_conversations():
-    if db is None:
-        return jsonify([])
-    conversations = Conversation.query.order_by(Conversation.timestamp.desc()).limit(100).all()
-    return jsonify([{
+    if request.mimetype == 'multipart/form-data' or 'filename' not in request.args:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'error': 'No file selected'})
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'success': False, 'error': 'No file selected'})
+        filename, stream = file.filename, file.stream
+    else:
+        filename, stream = request.args['filename'], request.stream
+
+    if not allowed_file(filename):
+        return jsonify({'success': False, 'error': 'File type not allowed'})
+    filename = secure_filename(filename)
+
+    # Charge the body up front; a chunked body is charged once its size is known
+    wait = rate_limit_wait('upload', session_id, request.remote_addr, request.content_length or 0)
+    if wait:
+        return too_many_requests(wait)
+
+    try:
+        with timed_stage('upload_store'):
+            blob = upload_store().write(stream, app.config['MAX_CONTENT_LENGTH'])
+        if request.content_length is None:
+            rate_limit_wait('upload', session_id, request.remote_addr, blob[2], force=True)
+        return jsonify(record_upload(session_id, filename, blob))
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return jsonify({'success': False, 'error': 'File too large'}), 413
+    except Exception:
+        app.logger.exception('Upload of %s failed', filename)
+        return jsonify({'success': False, 'error': 'File upload failed'}), 500
+
+def owned_upload(upload_id):
+    """Return the metadata of one of the caller's resumable uploads, or None."""
+    try:
+        metadata = upload_store().metadata(upload_id)
+    except KeyError:
+        return None
+    return metadata if metadata['session_id'] == session.get('session_id') else None
+
+@app.route('/upload/sessions', methods=['POST'])
+def begin_upload():
+    """Start a resumable upload of ``{"filename": ..., "size": ...}``.
+
+    The file is then sent in any number of ``PATCH /upload/sessions/<id>``
+    requests, each carrying the ``Upload-Offset`` it starts at. After a
+    dropped connection, ``GET /upload/sessions/<id>`` tells where to resume.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    if not allowed_file(filename):
+        return jsonify({'success': False, 'error': 'File type not allowed'}), 400
+    if not isinstance(size, int) or size < 1:
+        return jsonify({'success': False, 'error': 'size must be a positive integer'}), 400
+    if size > app.config['UPLOAD_MAX_SIZE']:
+        return jsonify({'success': False, 'error': 'File too large'}), 413
+    upload_id = upload_store().begin(size, {
+        'session_id': get_session_id(),
+        'filename': secure_filename(filename),
+    })
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'size': size}), 201
+
+@app.route('/upload/sessions/<upload_id>')
+def upload_status(upload_id):
+    metadata = owned_upload(upload_id)
+    if metadata is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': upload_store().offset(upload_id), 'size': metadata['size']})
+
+@app.route('/upload/sessions/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    metadata = owned_upload(upload_id)
+    if metadata is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    wait = rate_limit_wait('upload', metadata['session_id'], request.remote_addr, request.content_length or 0)
+    if wait:
+        return too_many_requests(wait)
+    store = upload_store()
+    try:
+        start, offset = offset, store.append(upload_id, offset, request.stream)
+    except OffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return jsonify({'error': 'Chunk goes past the declared size'}), 413
+    if request.content_length is None:
+        rate_limit_wait('upload', metadata['session_id'], request.remote_addr, offset - start, force=True)
+    if offset < metadata['size']:
+        return jsonify({'upload_id': upload_id, 'offset': offset, 'size': metadata['size']})
+    with timed_stage('upload_store'):
+        blob = store.finish(upload_id)
+    result = record_upload(metadata['session_id'], metadata['filename'], blob)
+    return jsonify(dict(result, upload_id=upload_id, offset=offset, size=metadata['size']))
+
+def conversation_to_dict(c):
+    return {
         'id': c.id,
         'session_id': c.session_id,
         'message': c.message,
         'response': c.response,
         'timestamp': c.timestamp.isoformat(),
         'user_type': c.user_type
-    } for c in conversations])
+    }
 
-@app.route('/admin/tickets')
-def admin_tickets():
-    if db is None:
-        return jsonify([])
-    tickets = SupportTicket.query.order_by(SupportTicket.created_at.desc()).all()
-    return jsonify([{
+def ticket_to_dict(t):
+    return {
         'id': t.id,
         'session_id': t.session_id,
         'status': t.status,
         'priority': t.priority,
         'created_at': t.created_at.isoformat(),
         'assigned_agent': t.assigned_agent
-    } for t in tickets])
+    }
+
+def encode_cursor(timestamp, row_id):
+    raw = json.dumps([timestamp.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, ValueError):
+        raise ValueError('malformed cursor')
+
+def parse_datetime_arg(name):
+    value = request.args.get(name)
+    return datetime.fromisoformat(value) if value else None
+
+def paginate(query, model, timestamp_column):
+    """Return one page of ``query`` newest first, plus the cursor of the next page.
+
+    Pages are addressed by the (timestamp, id) of the last row returned, so
+    each page is a range scan on the (timestamp, id) index no matter how deep
+    into the table it is.
+    """
+    limit = min(request.args.get('limit', app.config['ADMIN_PAGE_SIZE'], type=int), app.config['ADMIN_MAX_PAGE_SIZE'])
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    since = parse_datetime_arg('since')
+    until = parse_datetime_arg('until')
+    if since is not None:
+        query = query.where(timestamp_column >= since)
+    if until is not None:
+        query = query.where(timestamp_column < until)
+    cursor = request.args.get('cursor')
+    if cursor:
+        query = query.where(db.tuple_(timestamp_column, model.id) < decode_cursor(cursor))
+
+    rows = db.session.execute(
+        query.order_by(timestamp_column.desc(), model.id.desc()).limit(limit + 1)
+    ).scalars().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], timestamp_column.key), rows[-1].id)
+    return rows, next_cursor
+
+def page_response(items, next_cursor):
+    # The body stays a plain list; the next page is linked from the headers
+    response = jsonify(items)
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{url_for(request.endpoint, _external=True, **args)}>; rel="next"'
+    return response
+
+@app.route('/admin/conversations')
+def admin_conversations():
+    if db is None:
+        return jsonify([])
+    # Make this worker's queued conversations visible before reading
+    conversation_writer.flush()
+    query = db.select(Conversation)
+    if request.args.get('session_id'):
+        query = query.where(Conversation.session_id == request.args['session_id'])
+    try:
+        conversations, next_cursor = paginate(query, Conversation, Conversation.timestamp)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    return page_response([conversation_to_dict(c) for c in conversations], next_cursor)
+
+@app.route('/admin/tickets')
+def admin_tickets():
+    if db is None:
+        return jsonify([])
+    query = db.select(SupportTicket)
+    for field in ('status', 'priority', 'session_id'):
+        if request.args.get(field):
+            query = query.where(getattr(SupportTicket, field) == request.args[field])
+    try:
+        tickets, next_cursor = paginate(query, SupportTicket, SupportTicket.created_at)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    return page_response([ticket_to_dict(t) for t in tickets], next_cursor)
+
+@app.route('/admin/slow-requests')
+def admin_slow_requests():
+    """Recent requests slower than PROFILE_SLOW_REQUEST_SECONDS, newest first, from every worker."""
+    limit = request.args.get('limit', app.config['ADMIN_PAGE_SIZE'], type=int)
+    if limit is None or limit < 1:
+        return jsonify({'error': 'Invalid query parameter: limit must be positive'}), 400
+    entries = profiler.recent(min(limit, app.config['ADMIN_MAX_PAGE_SIZE']))
+    if request.args.get('endpoint'):
+        entries = [entry for entry in entries if entry['endpoint'] == request.args['endpoint']]
+    return jsonify(entries)
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.route('/admin/events')
+def admin_events():
+    """Stream ticket and message events to agents as Server-Sent Events.
+
+    Replaces polling /admin/tickets: new tickets from any worker arrive as
+    soon as they are opened. ``type``, ``priority``, ``status`` and
+    ``session_id`` take comma-separated values to filter on.
+    """
+    subscription = event_bus.subscribe(
+        Subscription(parse_filters(request.args), app.config['EVENT_MAX_PENDING'])
+    )
+    keepalive = app.config['EVENT_KEEPALIVE']
+
+    def stream():
+        try:
+            yield ': connected\n\n'
+            while True:
+                event = subscription.get(timeout=keepalive)
+                # Comments keep proxies from closing an idle stream
+                yield ': keepalive\n\n' if event is None else format_event(event)
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+def iter_table_rows(table, since=None, until=None):
+    """Yield the rows of an export table in id order, fetched in batches.
+
+    Rows are read as plain tuples rather than ORM objects so nothing
+    accumulates in the session while a large table streams out.
+    """
+    model, timestamp_name = EXPORT_TABLES[table]
+    timestamp_column = getattr(model, timestamp_name)
+    query = db.select(model.__table__)
+    if since is not None:
+        query = query.where(timestamp_column >= since)
+    if until is not None:
+        query = query.where(timestamp_column < until)
+    query = query.order_by(model.id).execution_options(yield_per=app.config['EXPORT_BATCH_SIZE'])
+    for row in db.session.execute(query):
+        yield row._mapping
+
+def table_export(table, fmt, compress, since=None, until=None):
+    model = EXPORT_TABLES[table][0]
+    fieldnames = [column.name for column in model.__table__.columns]
+    return export_stream(iter_table_rows(table, since, until), fmt, fieldnames, compress)
+
+@app.route('/admin/export/<table>')
+def admin_export(table):
+    if db is None or table not in EXPORT_TABLES:
+        return jsonify({'error': 'Unknown table'}), 404
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(FORMATS)}"}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    try:
+        since = parse_datetime_arg('since')
+        until = parse_datetime_arg('until')
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    if table == 'conversations':
+        conversation_writer.flush()
+
+    filename = f'{table}.{fmt}' + ('.gz' if compress else '')
+    return Response(
+        stream_with_context(table_export(table, fmt, compress, since, until)),
+        mimetype='application/gzip' if compress else FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'},
+    )
+
+@cli_command('export')
+@click.argument('table', type=click.Choice(sorted(EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)), default='ndjson', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--since', type=click.DateTime(), help='Only rows at or after this time.')
+@click.option('--until', type=click.DateTime(), help='Only rows before this time.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default: stdout).')
+def export_table(table, fmt, compress, since, until, output):
+    """Stream a table to NDJSON or CSV."""
+    for chunk in table_export(table, fmt, compress, since, until):
+        output.write(chunk)
+
+# Retention
+
+def archive_rows(table, ids_query, model, timestamp_name, dependents=()):
+    """Move the rows whose ids ``ids_query`` selects to the archive, a batch at a time.
+
+    ``dependents`` are ``(model, column)`` pairs of rows referring to the
+    archived ones, deleted (not archived) along with them.
+    """
+    writer = ArchiveWriter(app.config['ARCHIVE_DIR'])
+    batch_size = app.config['RETENTION_BATCH_SIZE']
+    moved = 0
+    while True:
+        ids = db.session.execute(ids_query.limit(batch_size)).scalars().all()
+        if not ids:
+            db.session.commit()
+            return moved
+        rows = db.session.execute(db.select(model.__table__).where(model.id.in_(ids)).order_by(model.id))
+        writer.write(table, [row._mapping for row in rows], timestamp_name)
+        for dependent, column in dependents:
+            db.session.execute(db.delete(dependent).where(column.in_(ids)))
+        db.session.execute(db.delete(model).where(model.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+        time.sleep(app.config['RETENTION_PAUSE'])
+
+def expired_row_ids(table, cutoff):
+    """Query for the ids of ``table`` rows past their retention, oldest first."""
+    if table == 'conversations':
+        active_sessions = db.select(Conversation.session_id).where(Conversation.timestamp >= cutoff)
+        ticketed_sessions = db.select(SupportTicket.session_id).where(SupportTicket.status != 'closed')
+        return (
+            db.select(Conversation.id)
+            .where(
+                Conversation.timestamp < cutoff,
+                Conversation.session_id.not_in(active_sessions),
+                Conversation.session_id.not_in(ticketed_sessions),
+            )
+            .order_by(Conversation.timestamp, Conversation.id)
+        )
+    if table == 'tickets':
+        return (
+            db.select(SupportTicket.id)
+            .where(SupportTicket.status == 'closed', SupportTicket.created_at < cutoff)
+            .order_by(SupportTicket.created_at, SupportTicket.id)
+        )
+    return db.select(UploadedFile.id).where(UploadedFile.upload_time < cutoff).order_by(UploadedFile.id)
+
+def sweep_upload_storage():
+    """Delete blobs no upload refers to and abandoned partial uploads.
+
+    Returns ``(files, bytes)`` removed.
+    """
+    store = upload_store()
+    grace = app.config['ORPHAN_BLOB_GRACE']
+    files = freed = 0
+
+    def sweep(batch):
+        nonlocal files, freed
+        referenced = set(db.session.execute(
+            db.select(UploadedFile.content_hash).where(UploadedFile.content_hash.in_({d for _, d in batch}))
+        ).scalars())
+        db.session.commit()
+        for name, digest in batch:
+            if digest not in referenced:
+                size = remove_if_idle(store.path(name), grace)
+                if size is not None:
+                    files += 1
+                    freed += size
+
+    batch = []
+    for blob in store.blobs():
+        batch.append(blob)
+        if len(batch) >= app.config['RETENTION_BATCH_SIZE']:
+            sweep(batch)
+            batch = []
+    if batch:
+        sweep(batch)
+    for path in store.incomplete(app.config['INCOMPLETE_UPLOAD_TTL']):
+        size = remove_if_idle(path, 0)
+        if size is not None:
+            files += 1
+            freed += size
+    return files, freed
+
+def run_retention():
+    """Archive expired rows, sweep upload storage and vacuum; returns a summary."""
+    summary = {}
+    with app.app_context():
+        now = datetime.utcnow()
+        for table, days in app.config['RETENTION_POLICIES'].items():
+            if days is None:
+                continue
+            model, timestamp_name = EXPORT_TABLES[table]
+            dependents = [(UploadJob, UploadJob.upload_id)] if table == 'uploads' else []
+            ids_query = expired_row_ids(table, now - timedelta(days=days))
+            summary[f'{table}_archived'] = archive_rows(table, ids_query, model, timestamp_name, dependents)
+        summary['files_removed'], summary['bytes_freed'] = sweep_upload_storage()
+        summary['pages_vacuumed'] = incremental_vacuum(
+            db.engine, app.config['VACUUM_PAGES'], app.config['RETENTION_PAUSE']
+        )
+    app.logger.info('Retention run: %s', summary)
+    return summary
+
+retention_task = PeriodicTask(
+    run_retention, app.config['RETENTION_INTERVAL'], os.path.join(app.instance_path, 'retention.lock')
+)
+
+@app.before_request
+def start_background_tasks():
+    if app.config['RETENTION_IN_APP']:
+        retention_task.ensure_started()
+
+@cli_command('retention')
+@click.option('--vacuum-full', is_flag=True,
+              help='Rebuild the SQLite file once so later runs can vacuum incrementally; locks the database meanwhile.')
+def retention(vacuum_full):
+    """Archive old conversations and tickets, remove orphaned blobs, vacuum."""
+    if vacuum_full and db.engine.dialect.name == 'sqlite':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.exec_driver_sql('VACUUM')
+    summary = retention_task.run_once()
+    if summary is None:
+        raise click.ClickException('Retention is already running in another process')
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+
+@cli_command('replay')
+@click.argument('input', type=click.File('r'))
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Output file (default: stdout).')
+@click.option('--workers', type=int, help='Processes to answer on (default: one per CPU).')
+@click.option('--chunk-size', default=1000, show_default=True, help='Lines sent to a process at a time.')
+@click.option('--side-effects', is_flag=True,
+              help='Answer one message at a time like /chat: keep follow-up topics, open tickets and save conversations.')
+def replay_messages(input, output, workers, chunk_size, side_effects):
+    """Answer a JSONL file of messages, writing the intent and response of each."""
+    if not side_effects:
+        knowledge_base.current()  # compiles the snapshot if the content changed
+        count = replay(input, output, knowledge_base.snapshot_path, app.config['FAQ_MIN_CONFIDENCE'], workers, chunk_size)
+    else:
+        count = 0
+        for number, line in enumerate(input, 1):
+            if not line.strip():
+                continue
+            record = parse_line(line, number)
+            if 'error' not in record:
+                session_id = record.get('session_id') or 'replay'
+                reply = handle_message(record['message'], session_id)
+                save_conversation(record['message'], reply.response, session_id)
+                record = dict(record, intent=reply.intent, response=reply.response)
+            output.write(json.dumps(record) + '\n')
+            count += 1
+        conversation_writer.flush()
+    click.echo(f'Replayed {count} messages', err=True)
+
+@cli_command('process-uploads')
+@click.option('--once', is_flag=True, help='Exit once no jobs are left instead of waiting for more.')
+def process_uploads(once):
+    """Run upload processing jobs, for deployments with UPLOAD_PROCESSING_IN_APP off."""
+    while True:
+        upload_processor.run_until_idle()
+        if once:
+            break
+        time.sleep(app.config['UPLOAD_PROCESSING_POLL_INTERVAL'])
+    print(f'Processed {upload_processor.completed} uploads, {upload_processor.failed} failed')
+
+@cli_command('migrate-database')
+@click.argument('target_url')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows copied per INSERT.')
+def migrate_database(target_url, batch_size):
+    """Copy every table into an empty database, e.g. PostgreSQL."""
+    conversation_writer.flush()
+    target = create_engine(database_uri(target_url))
+    add_open_ticket_clause(target.dialect.name)
+    db.metadata.create_all(target)
+    with target.begin() as connection:
+        # Parents first, so foreign keys hold on the way in
+        for table in db.metadata.sorted_tables:
+            if connection.execute(db.select(db.func.count()).select_from(table)).scalar():
+                raise click.ClickException(f'{table.name} already has rows in the target database')
+            query = db.select(table).order_by(*table.primary_key.columns).execution_options(yield_per=batch_size)
+            copied = 0
+            for rows in db.session.execute(query).mappings().partitions():
+                connection.execute(table.insert(), [dict(row) for row in rows])
+                copied += len(rows)
+            if target.dialect.name == 'postgresql' and 'id' in table.c:
+                # Explicit ids do not advance the sequence behind the column
+                connection.execute(db.text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE(MAX(id), 0) + 1, false)"
+                    f" FROM {table.name}"
+                ))
+            print(f'{table.name}: {copied} rows')
+
+@cli_command('upgrade-database')
+def upgrade_database():
+    """Add the tables, columns and indexes an older database lacks."""
+    with app.app_context():
+        changes = upgrade_schema(db.engine, db.metadata, INDEX_UPGRADES)
+    for change in changes:
+        print(change)
+    print(f'{len(changes)} changes')
+
+@cli_command('compile-knowledge-base')
+def compile_knowledge_base():
+    """Compile the knowledge base snapshot that running workers pick up."""
+    version = compile_snapshot(app.config['KNOWLEDGE_BASE_PATH'], app.config['KNOWLEDGE_BASE_SNAPSHOT'])
+    print(f"Compiled knowledge base {version} into {app.config['KNOWLEDGE_BASE_SNAPSHOT']}")
 
 if __name__ == '__main__':
-    create_tables()
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
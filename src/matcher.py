@@ -0,0 +1,359 @@
+"""Keyword matching for chat intents.
+
+Messages are tokenized and stemmed, misspelled tokens are corrected against
+the keyword vocabulary, and the resulting token sequence runs through a
+single Aho-Corasick automaton. Matching therefore respects word boundaries
+("hi" does not fire inside "this") and a message is scanned once no matter
+how many keywords are registered. Only tokens that are not words of their
+own are corrected, so "humane" or "logic" never turn into "human" or
+"login".
+"""
+from bisect import bisect_left
+from collections import deque
+import re
+
+NO_MATCH = -1
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Common words that are never spell-corrected into a keyword
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been
+before being below between both but by can could did do does doing down during
+each few for from further get got had has have having he her here hers him his
+how i if in into is it its just me more most my no nor not now of off on once
+only or other our out over own please same she should so some such than that
+the their them then there these they this those through to too under until up
+very was we were what when where which while who whom why will with would you
+your
+""".split())
+
+
+def stem(token):
+    """Strip common English inflections so "billing" and "bills" meet at "bill"."""
+    if len(token) <= 3:
+        return token
+    if token.endswith('ies') and len(token) > 4:
+        return token[:-3] + 'y'
+    if token.endswith('ing') and len(token) >= 6:
+        return token[:-3]
+    if token.endswith('ed') and len(token) >= 5:
+        return token[:-2]
+    if token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Return the lowercase word tokens of ``text``."""
+    return TOKEN_RE.findall(text.lower())
+
+
+def normalize(text):
+    """Return the stemmed tokens of ``text``."""
+    return [stem(token) for token in tokenize(text)]
+
+
+def load_words(path):
+    """Read a word list, one word per line; lines starting with ``#`` are comments."""
+    with open(path, encoding='utf-8') as f:
+        return {line.strip().lower() for line in f if line.strip() and not line.startswith('#')}
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance, or ``limit + 1`` once it is exceeded."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous2 is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def _deletes(term, distance):
+    """All strings reachable from ``term`` by removing up to ``distance`` characters."""
+    found = {term}
+    frontier = [term]
+    for _ in range(distance):
+        next_frontier = []
+        for word in frontier:
+            for i in range(len(word)):
+                candidate = word[:i] + word[i + 1:]
+                if candidate not in found:
+                    found.add(candidate)
+                    next_frontier.append(candidate)
+        frontier = next_frontier
+    return found
+
+
+class SpellIndex:
+    """SymSpell-style lookup of the closest vocabulary term for a misspelled token.
+
+    Every term is indexed under the strings obtained by deleting up to
+    ``max_distance`` characters from it, so a lookup only generates the
+    deletes of the query and verifies the handful of candidates they hit.
+    """
+
+    def __init__(self, terms, max_distance=2, min_length=4):
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.deletes = {}
+        self.terms = sorted(term for term in set(terms) if len(term) >= min_length)
+        for term_id, term in enumerate(self.terms):
+            for variant in _deletes(term, max_distance):
+                self.deletes.setdefault(variant, []).append(term_id)
+
+    def to_snapshot(self, writer, prefix):
+        writer.meta[prefix + 'max_distance'] = self.max_distance
+        writer.meta[prefix + 'min_length'] = self.min_length
+        writer.add_strings(prefix + 'terms', self.terms)
+        writer.add_postings(prefix + 'deletes', self.deletes)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, prefix):
+        spell = cls.__new__(cls)
+        spell.max_distance = snapshot.meta[prefix + 'max_distance']
+        spell.min_length = snapshot.meta[prefix + 'min_length']
+        spell.terms = snapshot.strings(prefix + 'terms')
+        spell.deletes = snapshot.postings(prefix + 'deletes')
+        return spell
+
+    @staticmethod
+    def allowed_distance(token):
+        # Short words are too easy to confuse, so only longer tokens are corrected
+        if len(token) >= 9:
+            return 2
+        if len(token) >= 5:
+            return 1
+        return 0
+
+    def lookup(self, token):
+        """Return the closest indexed term to ``token``, or None."""
+        limit = min(self.allowed_distance(token), self.max_distance)
+        if limit == 0 or token in STOPWORDS:
+            return None
+        best, best_distance = None, limit + 1
+        seen = set()
+        for variant in _deletes(token, limit):
+            for term_id in self.deletes.get(variant, ()):
+                if term_id in seen:
+                    continue
+                seen.add(term_id)
+                term = self.terms[term_id]
+                distance = edit_distance(token, term, limit)
+                if distance > limit:
+                    continue
+                if distance < best_distance or (distance == best_distance and term < best):
+                    best, best_distance = term, distance
+        return best
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over stemmed keyword tokens.
+
+    Every keyword carries a priority. When several keywords occur in the same
+    message the lowest priority value wins, and ties go to the keyword that
+    was added first.
+    """
+
+    def __init__(self, fuzzy=True, dictionary=None):
+        self.fuzzy = fuzzy
+        self.dictionary = dictionary  # words never corrected, e.g. a set
+        self._entries = []  # (priority, order, keyword, intent)
+        self._compiled = False
+
+    def add(self, keyword, intent, priority=0):
+        if self._compiled:
+            raise RuntimeError('matcher is already compiled')
+        if normalize(keyword):
+            self._entries.append((priority, len(self._entries), keyword.lower(), intent))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def compile(self):
+        # Rank keywords by (priority, insertion order); a smaller rank wins
+        self._entries.sort()
+        self.intents = [entry[3] for entry in self._entries]
+        self.keywords = [entry[2] for entry in self._entries]
+        self._build_vocabulary()
+        self.spell = SpellIndex(self.vocabulary) if self.fuzzy else None
+        goto, own = self._build_trie()
+        fail, best, out_link = self._link_failures(goto, own)
+        self._flatten(goto)
+        self._fail = fail
+        self._own = own
+        self._best = best
+        self._out_link = out_link
+        self._compiled = True
+        return self
+
+    def _build_vocabulary(self):
+        # Inverted index from normalized token to the intents that use it;
+        # the position of a token in the vocabulary is its automaton symbol
+        self.index = {}
+        for keyword, intent in zip(self.keywords, self.intents):
+            for token in normalize(keyword):
+                intents = self.index.setdefault(token, [])
+                if intent not in intents:
+                    intents.append(intent)
+        self.vocabulary = {token: symbol for symbol, token in enumerate(sorted(self.index))}
+
+    def _build_trie(self):
+        """Return the goto table of the keyword trie and the keyword rank ending at each state."""
+        goto = [{}]
+        own = [NO_MATCH]
+        for rank, keyword in enumerate(self.keywords):
+            state = 0
+            for token in normalize(keyword):
+                symbol = self.vocabulary[token]
+                nxt = goto[state].get(symbol)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][symbol] = nxt
+                    goto.append({})
+                    own.append(NO_MATCH)
+                state = nxt
+            # Duplicate keywords keep their best-ranked intent
+            if own[state] == NO_MATCH:
+                own[state] = rank
+        return goto, own
+
+    @staticmethod
+    def _link_failures(goto, own):
+        """Breadth-first pass computing failure links and, for every state,
+        the best keyword ending at it or at any of its proper suffixes."""
+        fail = [0] * len(goto)
+        best = list(own)
+        out_link = [0] * len(goto)
+        queue = deque(goto[0].values())
+        order = []
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for symbol, child in goto[state].items():
+                f = fail[state]
+                while f and symbol not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(symbol, 0)
+                queue.append(child)
+        for state in order:
+            f = fail[state]
+            out_link[state] = f if own[f] != NO_MATCH else out_link[f]
+            inherited = best[f]
+            if inherited != NO_MATCH and (best[state] == NO_MATCH or inherited < best[state]):
+                best[state] = inherited
+        return fail, best, out_link
+
+    def _flatten(self, goto):
+        # Flatten transitions into sorted CSR arrays
+        self._ptr = [0]
+        self._symbols = []
+        self._next = []
+        for edges in goto:
+            for symbol in sorted(edges):
+                self._symbols.append(symbol)
+                self._next.append(edges[symbol])
+            self._ptr.append(len(self._symbols))
+
+    def to_snapshot(self, writer, prefix):
+        """Add the compiled automaton to a snapshot; intents must be integers."""
+        writer.meta[prefix + 'fuzzy'] = self.fuzzy
+        writer.add_strings(prefix + 'keywords', self.keywords)
+        writer.add_array(prefix + 'intents', 'i', self.intents)
+        writer.add_strings(prefix + 'vocabulary', sorted(self.vocabulary, key=self.vocabulary.get))
+        writer.add_postings(prefix + 'index', self.index)
+        for name in ('ptr', 'symbols', 'next', 'fail', 'own', 'best', 'out_link'):
+            writer.add_array(prefix + name, 'i', getattr(self, '_' + name))
+        if self.spell is not None:
+            self.spell.to_snapshot(writer, prefix + 'spell.')
+
+    @classmethod
+    def from_snapshot(cls, snapshot, prefix, dictionary=None):
+        """Rebuild a matcher that reads its tables straight from ``snapshot``."""
+        matcher = cls(fuzzy=snapshot.meta[prefix + 'fuzzy'], dictionary=dictionary)
+        matcher.keywords = snapshot.strings(prefix + 'keywords')
+        matcher.intents = snapshot.array(prefix + 'intents')
+        matcher.vocabulary = snapshot.strings(prefix + 'vocabulary')
+        matcher.index = snapshot.postings(prefix + 'index')
+        for name in ('ptr', 'symbols', 'next', 'fail', 'own', 'best', 'out_link'):
+            setattr(matcher, '_' + name, snapshot.array(prefix + name))
+        matcher.spell = SpellIndex.from_snapshot(snapshot, prefix + 'spell.') if matcher.fuzzy else None
+        matcher._compiled = True
+        return matcher
+
+    def is_word(self, token):
+        return self.dictionary is not None and token in self.dictionary
+
+    def symbols(self, text, fuzzy=True):
+        """Map ``text`` to automaton symbols, correcting typos if ``fuzzy``.
+
+        Tokens outside the vocabulary map to None, and so do words of the
+        dictionary that are close to a keyword but are not one.
+        """
+        vocabulary = self.vocabulary
+        spell = self.spell if fuzzy else None
+        result = []
+        for token in tokenize(text):
+            stemmed = stem(token)
+            symbol = vocabulary.get(stemmed)
+            if symbol is None and spell is not None and not self.is_word(token):
+                corrected = spell.lookup(stemmed)
+                if corrected is not None:
+                    symbol = vocabulary.get(corrected)
+            result.append(symbol)
+        return result
+
+    def _step(self, state, symbol):
+        if symbol is None:
+            return 0
+        ptr, symbols = self._ptr, self._symbols
+        while True:
+            lo, hi = ptr[state], ptr[state + 1]
+            i = bisect_left(symbols, symbol, lo, hi)
+            if i < hi and symbols[i] == symbol:
+                return self._next[i]
+            if state == 0:
+                return 0
+            state = self._fail[state]
+
+    def match(self, text, fuzzy=True):
+        """Return the highest-priority intent found in ``text``, or None.
+
+        With ``fuzzy`` off, only keywords spelled out in ``text`` count.
+        """
+        best = NO_MATCH
+        state = 0
+        best_by_state = self._best
+        for symbol in self.symbols(text, fuzzy):
+            state = self._step(state, symbol)
+            rank = best_by_state[state]
+            if rank != NO_MATCH and (best == NO_MATCH or rank < best):
+                best = rank
+                if best == 0:
+                    break
+        return None if best == NO_MATCH else self.intents[best]
+
+    def find_all(self, text):
+        """Yield ``(keyword, intent)`` for every keyword occurrence in ``text``."""
+        state = 0
+        for symbol in self.symbols(text):
+            state = self._step(state, symbol)
+            hit = state if self._own[state] != NO_MATCH else self._out_link[state]
+            while hit:
+                rank = self._own[hit]
+                yield self.keywords[rank], self.intents[rank]
+                hit = self._out_link[hit]
@@ -0,0 +1,321 @@
+"""Counters and histograms exported in the Prometheus text format.
+
+Metrics are updated in process memory, which keeps an update to well under
+a microsecond. For ``/metrics`` to cover every gunicorn worker, each process
+writes its values to a file in a shared directory about once a second, and
+:meth:`Registry.render` adds up the files of all processes. When a worker
+has exited, the next scrape adds its file into ``exited.json`` and deletes
+it, so totals never go backwards when a worker is replaced and a scrape
+reads one file per live worker.
+"""
+import atexit
+from bisect import bisect_left
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Seconds; from sub-millisecond cache hits to slow uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The summed values of workers that exited, and the names of their files
+EXITED = 'exited.json'
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self)
+
+    def sample(self):
+        with self._lock:
+            return self.counts + [self.sum]
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def labels(self, *values):
+        """The series for one combination of label values."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(tuple(str(v) for v in values), self._new_child())
+                self._children[values] = child
+        return child
+
+    def samples(self):
+        """``{label values: sample}`` with label values as lists for JSON."""
+        seen = {}
+        for values, child in list(self._children.items()):
+            seen[id(child)] = (tuple(str(v) for v in values), child)
+        return {json.dumps(values): child.sample() for values, child in seen.values()}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(totals, snapshot):
+    """Add the samples of ``snapshot`` to ``totals``, both ``{name: {label values: sample}}``."""
+    for name, samples in snapshot.items():
+        merged = totals.setdefault(name, {})
+        for key, sample in samples.items():
+            if key not in merged:
+                merged[key] = sample
+            elif isinstance(sample, list):
+                merged[key] = [a + b for a, b in zip(merged[key], sample)]
+            else:
+                merged[key] = merged[key] + sample
+
+
+def _has_exited(filename):
+    """Whether the process that writes ``<pid>-<id>.json`` is gone."""
+    try:
+        os.kill(int(filename.split('-', 1)[0]), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        pass
+    return False
+
+
+class Registry:
+    """The metrics of the app, shared with other processes through ``directory``."""
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.metrics = {}
+        self._pid = None
+        self._path = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.configure(directory, flush_interval)
+        atexit.register(self.close)
+
+    def configure(self, directory=None, flush_interval=1.0):
+        """Set the constructor's arguments; only takes effect before :meth:`ensure_started`."""
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def ensure_started(self):
+        """Start writing this process's values; cheap to call on every request."""
+        if self._pid == os.getpid() or self.directory is None:
+            return
+        if self._pid is not None:
+            # A forked worker inherits its parent's values but reports its own
+            for metric in self.metrics.values():
+                metric._children.clear()
+                if not metric.labelnames:
+                    metric._unlabelled = metric.labels()
+        self._pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        self._thread.start()
+
+    def _snapshot(self):
+        return {name: metric.samples() for name, metric in self.metrics.items()}
+
+    def flush(self):
+        if self._path is None or self._pid != os.getpid():
+            return
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp_path, self._path)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Failed to write metrics to %s', self._path)
+
+    def close(self):
+        self.flush()
+
+    def _fold_exited(self, filenames):
+        """Add the files of exited workers into ``EXITED`` and delete them.
+
+        Returns the summed samples of all exited workers and the files of
+        the live ones. Names of folded files are kept in ``EXITED`` until
+        they are gone, so a file a crash left behind is never counted twice.
+        """
+        path = os.path.join(self.directory, EXITED)
+        exited = _read_json(path) or {'folded': [], 'samples': {}}
+        folded = set(exited['folded']) & set(filenames)
+        new = [filename for filename in filenames if filename not in folded and _has_exited(filename)]
+        if new:
+            for filename in new:
+                _merge(exited['samples'], _read_json(os.path.join(self.directory, filename)) or {})
+            exited['folded'] = sorted(folded.union(new))
+            with open(path + '.tmp', 'w') as f:
+                json.dump(exited, f)
+            os.replace(path + '.tmp', path)
+        for filename in folded.union(new):
+            try:
+                os.unlink(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        live = [filename for filename in filenames if filename not in folded and filename not in new]
+        return exited['samples'], live
+
+    def collect(self):
+        """Sum the samples of every process: ``{name: {label values: sample}}``."""
+        totals = {name: dict(samples) for name, samples in self._snapshot().items()}
+        if self.directory is None or not os.path.isdir(self.directory):
+            return totals
+        own = os.path.basename(self._path) if self._path is not None else None
+        # One scrape at a time, so workers never fold the same file twice
+        with open(os.path.join(self.directory, 'exited.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            filenames = [filename for filename in os.listdir(self.directory)
+                         if filename.endswith('.json') and filename not in (EXITED, own)]
+            exited, live = self._fold_exited(filenames)
+            _merge(totals, exited)
+            for filename in live:
+                _merge(totals, _read_json(os.path.join(self.directory, filename)) or {})
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        totals = self.collect()
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key in sorted(totals[name]):
+                values = json.loads(key)
+                sample = totals[name][key]
+                if metric.kind == 'counter':
+                    lines.append(f'{name}{_labels(metric.labelnames, values)} {_format_value(sample)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.upper_bounds + (math.inf,), sample[:-1]):
+                    cumulative += count
+                    le = (('le', _format_value(bound)),)
+                    lines.append(f'{name}_bucket{_labels(metric.labelnames, values, le)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(metric.labelnames, values)} {_format_value(sample[-1])}')
+                lines.append(f'{name}_count{_labels(metric.labelnames, values)} {cumulative}')
+        return '\n'.join(lines) + '\n'
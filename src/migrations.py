@@ -0,0 +1,76 @@
+"""Bring a database created by an earlier version of the app up to the models.
+
+``create_all()`` only creates missing tables; columns and indexes added to
+existing tables since are never created by it. :func:`upgrade_schema` adds
+columns the tables lack, then indexes with ``CREATE INDEX IF NOT EXISTS``,
+so it is cheap and safe to run on every start.
+"""
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(connection, table, existing):
+    """Add the columns of ``table`` not in ``existing``, returning a description of each.
+
+    Rows already in the table get a column's scalar default, as inserting
+    them through the model would have.
+    """
+    changes = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        if column.primary_key or (not column.nullable and column.server_default is None):
+            logger.warning('Database upgrade: cannot add required column %s.%s', table.name, column.name)
+            continue
+        ddl = CreateColumn(column).compile(dialect=connection.dialect)
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+        if column.default is not None and column.default.is_scalar:
+            connection.execute(table.update().where(column.is_(None)).values({column.name: column.default.arg}))
+        existing.add(column.name)
+        changes.append(f'added column {table.name}.{column.name}')
+    return changes
+
+
+def add_missing_indexes(connection, table, columns, indexes, before_index):
+    changes = []
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name in indexes:
+            continue
+        if any(column.name not in columns for column in index.columns):
+            logger.warning('Database upgrade: %s needs columns %s lacks', index.name, table.name)
+            continue
+        if index.name in before_index:
+            before_index[index.name](connection)
+        connection.execute(CreateIndex(index, if_not_exists=True))
+        changes.append(f'created index {index.name}')
+    return changes
+
+
+def upgrade_schema(engine, metadata, before_index=None):
+    """Create the tables, columns and indexes of ``metadata`` missing from ``engine``.
+
+    ``before_index`` maps index names to functions called with the
+    connection just before that index is created, e.g. to remove rows a new
+    unique index would reject. Returns a description of each change.
+    """
+    before_index = before_index or {}
+    changes = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing = set(inspector.get_table_names())
+        for table in metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(connection, checkfirst=True)
+                changes.append(f'created table {table.name}')
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            changes += add_missing_columns(connection, table, columns)
+            changes += add_missing_indexes(connection, table, columns, indexes, before_index)
+    for change in changes:
+        logger.info('Database upgrade: %s', change)
+    return changes
@@ -0,0 +1,173 @@
+"""Post-upload processing: type sniffing, thumbnails and text extraction.
+
+Everything here works on file paths and plain values only, so it can run
+in a separate worker process without the Flask app.
+"""
+import os
+import re
+import zipfile
+import zlib
+from xml.etree import ElementTree
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+# Leading bytes that identify a file type
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/msword'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+# The type each allowed extension must actually contain
+EXTENSION_TYPES = {
+    'txt': 'text/plain',
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'doc': 'application/msword',
+    'docx': DOCX_TYPE,
+}
+
+THUMBNAIL_SIZE = (256, 256)
+
+
+def sniff_type(path):
+    """Return the MIME type found in the content of ``path``."""
+    with open(path, 'rb') as f:
+        head = f.read(8192)
+    for signature, mime_type in SIGNATURES:
+        if head.startswith(signature):
+            if mime_type == 'application/zip' and _is_docx(path):
+                return DOCX_TYPE
+            return mime_type
+    if b'\x00' not in head:
+        try:
+            # A multi-byte character may be cut off at the end of the sample
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError as e:
+            if len(head) == 8192 and e.start >= len(head) - 3:
+                return 'text/plain'
+    return 'application/octet-stream'
+
+
+def _is_docx(path):
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return 'word/document.xml' in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
+def extension_matches(filename, mime_type):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return EXTENSION_TYPES.get(extension) == mime_type
+
+
+def make_thumbnail(path, thumbnail_path):
+    """Write a PNG thumbnail of an image; returns False without Pillow."""
+    if Image is None:
+        return False
+    with Image.open(path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        image.save(thumbnail_path, 'PNG')
+    return True
+
+
+def extract_text(path, mime_type, limit):
+    """Return up to ``limit`` characters of plain text, or None if there is none."""
+    if mime_type == 'text/plain':
+        with open(path, 'rb') as f:
+            text = f.read(limit * 4).decode('utf-8', 'replace')
+    elif mime_type == DOCX_TYPE:
+        text = _docx_text(path)
+    elif mime_type == 'application/pdf':
+        text = _pdf_text(path)
+    else:
+        return None
+    text = text.strip()
+    return text[:limit] if text else None
+
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def _docx_text(path):
+    paragraphs, current = [], []
+    with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as document:
+        for _, element in ElementTree.iterparse(document):
+            if element.tag == _WORD_NS + 't' and element.text:
+                current.append(element.text)
+            elif element.tag == _WORD_NS + 'p':
+                paragraphs.append(''.join(current))
+                current = []
+                element.clear()
+    return '\n'.join(paragraphs)
+
+
+_PDF_STREAM_RE = re.compile(rb'stream\r?\n(.*?)\r?\nendstream', re.S)
+_PDF_TEXT_RE = re.compile(rb'\[(.*?)\]\s*TJ|\((.*?)(?<!\\)\)\s*(?:Tj|\'|")', re.S)
+_PDF_STRING_RE = re.compile(rb'\((.*?)(?<!\\)\)', re.S)
+_PDF_ESCAPE_RE = re.compile(rb'\\([nrtbf()\\]|[0-7]{1,3})')
+_PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+
+def _pdf_unescape(match):
+    value = match.group(1)
+    if value[:1].isdigit():
+        return bytes([int(value, 8) & 0xff])
+    return _PDF_ESCAPES.get(value, value)
+
+
+def _pdf_text(path):
+    if pypdf is not None:
+        reader = pypdf.PdfReader(path)
+        return '\n'.join(page.extract_text() or '' for page in reader.pages)
+    # Without pypdf, read the string operands of the text operators in each
+    # content stream; enough for the simply encoded PDFs people attach
+    with open(path, 'rb') as f:
+        data = f.read()
+    lines = []
+    for stream in _PDF_STREAM_RE.findall(data):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for array, string in _PDF_TEXT_RE.findall(stream):
+            parts = _PDF_STRING_RE.findall(array) if array else [string]
+            lines.append(b''.join(_PDF_ESCAPE_RE.sub(_pdf_unescape, part) for part in parts))
+    return '\n'.join(line.decode('latin-1') for line in lines)
+
+
+def process_upload(path, thumbnail_path, text_limit):
+    """Inspect one stored upload and return what was found.
+
+    Returns a dict with ``mime_type``, ``thumbnail`` (whether one was
+    written to ``thumbnail_path``) and ``text``.
+    """
+    mime_type = sniff_type(path)
+    thumbnail = False
+    if mime_type.startswith('image/'):
+        thumbnail = make_thumbnail(path, thumbnail_path)
+    return {
+        'mime_type': mime_type,
+        'thumbnail': thumbnail,
+        'text': extract_text(path, mime_type, text_limit),
+    }
@@ -0,0 +1,298 @@
+"""Opt-in request profiling: sampled stack profiles, a slow-request log and SQL timings.
+
+A background thread looks at the stacks of the requests being profiled
+every ``interval`` seconds through ``sys._current_frames()``, so the
+requests themselves run at full speed and a request that is not profiled
+costs two dictionary operations. A fraction of requests are profiled from
+start to end; every request still running after ``slow_seconds`` is
+profiled from then on, and logged with the time it spent in each stage
+and in SQL when it ends.
+
+Profiles are written to ``directory`` as collapsed stacks (``.folded``,
+for flamegraph.pl or speedscope) and as ``pstats`` files (``.pstats``, for
+``python -m pstats`` or snakeviz), built from the same samples. The slow
+request log is one JSON line per request in ``slow-requests.ndjson``,
+appended to by every worker.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+import json
+import logging
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SLOW_LOG = 'slow-requests.ndjson'
+
+
+class RequestProfile:
+    """What is recorded about one request while it runs."""
+
+    def __init__(self, method, path, sampled):
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.start_time = datetime.now(timezone.utc)
+        self.stacks = Counter()  # tuples of code objects, outermost first -> samples
+        self.stages = defaultdict(float)
+        self.statements = {}  # SQL -> [count, total seconds, max seconds]
+
+
+def frame_stack(frame):
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+def code_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def code_key(code):
+    # The key cProfile gives a function in pstats files
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def write_collapsed(stacks, path):
+    """Write ``stacks`` as ``outer;inner;leaf count`` lines."""
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(';'.join(code_label(code) for code in stack) + f' {count}\n')
+
+
+def write_pstats(stacks, interval, path):
+    """Write ``stacks`` as a file ``pstats.Stats`` loads, each sample counting ``interval`` seconds.
+
+    A function's own time is the samples it was the innermost frame of, its
+    cumulative time the samples it was anywhere in, and its call count the
+    number of samples, as a sampler cannot see calls.
+    """
+    stats = {}
+    for stack, count in stacks.items():
+        seconds = count * interval
+        seen = set()
+        caller = None
+        for depth, code in enumerate(stack):
+            key = code_key(code)
+            cc, nc, tt, ct, callers = stats.setdefault(key, (0, 0, 0.0, 0.0, {}))
+            if key not in seen:
+                # Recursive functions count once per sample
+                seen.add(key)
+                nc += count
+                cc += count
+                ct += seconds
+            if depth == len(stack) - 1:
+                tt += seconds
+            if caller is not None:
+                ncalls, ccalls, ttime, ctime = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (ncalls + count, ccalls + count, ttime, ctime + seconds)
+            stats[key] = (cc, nc, tt, ct, callers)
+            caller = key
+    with open(path, 'wb') as f:
+        marshal.dump(stats, f)
+
+
+def tail_lines(path, count, block_size=64 * 1024):
+    """Return the last ``count`` lines of ``path``, oldest first, reading from the end."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return []
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        data = b''
+        while end > 0 and data.count(b'\n') <= count:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    return [line.decode('utf-8') for line in data.splitlines()[-count:] if line.strip()]
+
+
+class RequestProfiler:
+    """Profiles sampled and slow requests; off unless ``sample_rate`` or ``slow_seconds`` is set."""
+
+    def __init__(self, directory=None, sample_rate=0.0, slow_seconds=None, interval=0.005,
+                 max_files=1000, max_statements=10, log_max_bytes=10 * 1024 * 1024):
+        self.profiles_written = 0
+        self._active = {}  # thread id -> RequestProfile
+        self._pid = None
+        self._lock = threading.Lock()
+        self.configure(directory, sample_rate, slow_seconds, interval, max_files, max_statements, log_max_bytes)
+
+    def configure(self, directory=None, sample_rate=0.0, slow_seconds=None, interval=0.005,
+                  max_files=1000, max_statements=10, log_max_bytes=10 * 1024 * 1024):
+        """Set the constructor's arguments, e.g. once the app's settings are final."""
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.max_files = max_files
+        self.max_statements = max_statements
+        self.log_max_bytes = log_max_bytes
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_seconds is not None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # A forked worker inherits the requests its parent had in flight
+                self._active = {}
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    def start(self, method, path):
+        """Start recording the request running on this thread; None if profiling is off."""
+        if not self.enabled:
+            return None
+        self._ensure_started()
+        profile = RequestProfile(method, path, random.random() < self.sample_rate)
+        self._active[profile.thread_id] = profile
+        return profile
+
+    def current(self):
+        """The profile of the request running on this thread, if any."""
+        return self._active.get(threading.get_ident()) if self._active else None
+
+    def add_stage(self, stage, seconds):
+        profile = self.current()
+        if profile is not None:
+            profile.stages[stage] += seconds
+
+    def add_statement(self, statement, seconds):
+        profile = self.current()
+        if profile is None:
+            return
+        entry = profile.statements.get(statement)
+        if entry is None:
+            profile.statements[statement] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%.2fms %s %s: %s', seconds * 1000, profile.method, profile.path, statement)
+
+    def finish(self, profile, endpoint, status):
+        """Stop recording ``profile``; writes its files and returns its log entry if kept, else None."""
+        duration = time.perf_counter() - profile.started
+        self._active.pop(profile.thread_id, None)
+        slow = self.slow_seconds is not None and duration >= self.slow_seconds
+        if not (slow or profile.sampled):
+            return None
+        # The sampler may still be adding the sample it took as we finished
+        stacks = profile.stacks.copy()
+        name = self._write_profile(profile, stacks) if stacks else None
+        statements = sorted(profile.statements.items(), key=lambda item: item[1][1], reverse=True)
+        entry = {
+            'time': profile.start_time.isoformat(),
+            'method': profile.method,
+            'path': profile.path,
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3),
+            'sampled': profile.sampled,
+            'slow': slow,
+            'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in profile.stages.items()},
+            'sql': {
+                'count': sum(count for count, _, _ in profile.statements.values()),
+                'total_ms': round(sum(total for _, total, _ in profile.statements.values()) * 1000, 3),
+                'statements': [
+                    {'statement': statement, 'count': count,
+                     'total_ms': round(total * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+                    for statement, (count, total, longest) in statements[:self.max_statements]
+                ],
+            },
+            'samples': sum(stacks.values()),
+            'profile': name,
+            'pid': os.getpid(),
+        }
+        if slow:
+            self._log(entry)
+        return entry
+
+    def _write_profile(self, profile, stacks):
+        if self.directory is None:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = profile.start_time.strftime('%Y%m%dT%H%M%S')
+        self.profiles_written += 1
+        name = f'{stamp}-{os.getpid()}-{self.profiles_written}'
+        base = os.path.join(self.directory, name)
+        write_collapsed(stacks, base + '.folded')
+        write_pstats(stacks, self.interval, base + '.pstats')
+        self._prune()
+        return name
+
+    def _prune(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(('.folded', '.pstats')))
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _log(self, entry):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, SLOW_LOG)
+        try:
+            if os.path.getsize(path) > self.log_max_bytes:
+                os.replace(path, path + '.1')
+        except FileNotFoundError:
+            pass
+        # One write per line, so lines from different workers never interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def recent(self, limit=100):
+        """The last ``limit`` slow requests of all workers, newest first."""
+        if self.directory is None:
+            return []
+        entries = []
+        for line in reversed(tail_lines(os.path.join(self.directory, SLOW_LOG), limit)):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass  # cut short by a crash
+        return entries
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            now = time.perf_counter()
+            due = [profile for profile in list(self._active.values())
+                   if profile.sampled or (self.slow_seconds is not None and now - profile.started >= self.slow_seconds)]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for profile in due:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.stacks[frame_stack(frame)] += 1
+            del frames
+        with self._lock:
+            # Profiling was turned off; the next start() starts a new thread
+            self._pid = None
@@ -0,0 +1,134 @@
+"""Token buckets shared by all worker processes through a memory-mapped file.
+
+The file is a fixed hash table: keys hash to a group of ``WAYS`` slots and
+each slot holds a key hash, a token count and the time it was last refilled.
+A bucket is updated under a ``lockf`` lock on its group only, so workers
+contend only when they hit the same group at the same moment, and a take is
+a few microseconds with no system call beyond the lock. When a group is
+full the least recently used bucket in it is reused; its owner starts over
+with a full bucket, which errs on the side of letting traffic through.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+SLOT = struct.Struct('<Qdd')  # key hash, tokens, last refill (epoch seconds)
+WAYS = 8
+
+
+def key_hash(key):
+    # Python's hash() differs between processes; 0 marks an empty slot
+    digest = hashlib.blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | 1
+
+
+class TokenBucketStore:
+    """Token buckets keyed by string, in ``path`` or in this process only if ``path`` is None."""
+
+    def __init__(self, path=None, slots=65536):
+        self.path = path
+        self.groups = max(1, slots // WAYS)
+        self.size = self.groups * WAYS * SLOT.size
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            return
+        if self.path is None:
+            self._map = mmap.mmap(-1, self.size)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < self.size:
+            # Never shrink: other workers may have the file mapped
+            os.ftruncate(fd, self.size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+
+    def take(self, key, cost, capacity, rate, force=False):
+        """Spend ``cost`` tokens from the bucket of ``key``.
+
+        Buckets hold up to ``capacity`` tokens and refill at ``rate`` tokens
+        a second. Returns 0 if the tokens were spent, or else the seconds
+        until they will be available. A cost above ``capacity`` is allowed
+        from a full bucket and leaves it in debt. ``force`` spends the
+        tokens regardless, for costs only known after the work is done.
+        """
+        return self.take_all([(key, capacity, rate)], cost, force)
+
+    def take_all(self, buckets, cost, force=False):
+        """Spend ``cost`` tokens from each of ``buckets`` or from none of them.
+
+        ``buckets`` lists ``(key, capacity, rate)`` as for :meth:`take`. The
+        groups of all the buckets are locked together, so a bucket that
+        refuses leaves the others untouched. Returns 0 if the tokens were
+        spent, or else the seconds until every bucket has them.
+        """
+        hashes = [key_hash(key) for key, _, _ in buckets]
+        # Lock in one order so that two workers never wait on each other
+        groups = sorted({h % self.groups for h in hashes})
+        if self._pid != os.getpid():
+            # The lock may have been held by another thread when we forked;
+            # the shared mapping itself is inherited as is
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._lock:
+            self._open()
+            for group in groups:
+                self._lock_group(group, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                slots = [self._refill(h, capacity, rate, now) for h, (_, capacity, rate) in zip(hashes, buckets)]
+                waits = [
+                    (min(cost, capacity) - tokens) / rate if rate > 0 else float('inf')
+                    for (_, tokens), (_, capacity, rate) in zip(slots, buckets)
+                    if tokens < min(cost, capacity)
+                ]
+                if waits and not force:
+                    return max(waits)
+                for h, (offset, tokens) in zip(hashes, slots):
+                    SLOT.pack_into(self._map, offset, h, tokens - cost, now)
+                return 0.0
+            finally:
+                for group in groups:
+                    self._lock_group(group, fcntl.LOCK_UN)
+
+    def _lock_group(self, group, operation):
+        if self._fd is not None:
+            fcntl.lockf(self._fd, operation, WAYS * SLOT.size, group * WAYS * SLOT.size)
+
+    def _refill(self, h, capacity, rate, now):
+        # Finds or claims the slot of hash h and stores its refilled count
+        start = (h % self.groups) * WAYS * SLOT.size
+        free = oldest = None
+        for way in range(WAYS):
+            offset = start + way * SLOT.size
+            slot_hash, tokens, updated = SLOT.unpack_from(self._map, offset)
+            if slot_hash == h:
+                tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+                break
+            if slot_hash == 0:
+                if free is None:
+                    free = offset
+            elif oldest is None or updated < oldest[1]:
+                oldest = (offset, updated)
+        else:
+            offset = free if free is not None else oldest[0]
+            tokens = capacity
+        SLOT.pack_into(self._map, offset, h, tokens, now)
+        return offset, tokens
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,100 @@
+"""Offline replay of chat messages through the knowledge base.
+
+Reads JSON lines, each ``{"message": ...}`` plus any other fields (or just
+a JSON string), and writes each one back with the ``intent`` and
+``response`` it gets. Messages are answered as the first message of a
+session would be, with no tickets opened and nothing saved, so replays
+can be diffed between knowledge base versions.
+
+Lines are answered in chunks on a pool of processes. Each process
+memory-maps the same compiled snapshot, so the knowledge base is loaded
+once per machine rather than once per process. Output keeps input order,
+and only a few chunks per process are in flight at a time, so input of
+any length is replayed in bounded memory.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import multiprocessing
+
+from knowledge import KnowledgeBase
+
+_kb = None
+_min_confidence = None
+
+
+def init_worker(snapshot_path, min_confidence):
+    global _kb, _min_confidence
+    _kb = KnowledgeBase.load(snapshot_path)
+    _min_confidence = min_confidence
+
+
+def answer_record(record):
+    """Return ``record`` with the intent and response its message gets."""
+    intent = _kb.answer(record['message'], _min_confidence)
+    return dict(record, intent=intent.name, response=intent.response)
+
+
+def parse_line(line, number):
+    """Return the record of one input line, or an error record."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return {'line': number, 'error': 'invalid JSON'}
+    if isinstance(record, str):
+        record = {'message': record}
+    if not isinstance(record, dict) or not isinstance(record.get('message'), str):
+        return {'line': number, 'error': 'expected a "message" string'}
+    return record
+
+
+def answer_lines(chunk):
+    """Answer a chunk of ``(line number, line)`` pairs; returns the output text."""
+    out = []
+    for number, line in chunk:
+        record = parse_line(line, number)
+        if 'error' not in record:
+            record = answer_record(record)
+        out.append(json.dumps(record) + '\n')
+    return ''.join(out)
+
+
+def iter_chunks(lines, chunk_size):
+    numbered = ((number, line) for number, line in enumerate(lines, 1) if line.strip())
+    while True:
+        chunk = list(itertools.islice(numbered, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def replay(lines, output, snapshot_path, min_confidence, workers=None, chunk_size=1000):
+    """Write the answer to every line of ``lines`` to ``output``; returns the lines written."""
+    written = 0
+    chunks = iter_chunks(lines, chunk_size)
+    if workers == 1:
+        init_worker(snapshot_path, min_confidence)
+        for chunk in chunks:
+            output.write(answer_lines(chunk))
+            written += len(chunk)
+        return written
+
+    workers = workers or multiprocessing.cpu_count()
+    # spawn, like the upload pool: forking a process with threads is unsafe
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker, initargs=(snapshot_path, min_confidence),
+    ) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((pool.submit(answer_lines, chunk), len(chunk)))
+            if len(pending) >= 2 * workers:
+                future, size = pending.popleft()
+                output.write(future.result())
+                written += size
+        while pending:
+            future, size = pending.popleft()
+            output.write(future.result())
+            written += size
+    return written
@@ -0,0 +1,161 @@
+"""Building blocks of the retention job: archives, blob sweeping, vacuuming.
+
+Everything here works in small steps (one batch of rows, one directory,
+a few hundred pages) so the job can run next to live traffic without
+holding the database's write lock for long.
+"""
+import atexit
+from collections import defaultdict
+import fcntl
+import gzip
+import logging
+import os
+import threading
+import time
+
+from export import iter_ndjson
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveWriter:
+    """Appends rows to gzipped NDJSON files, one file per table and month.
+
+    Each batch is appended as its own gzip member, which ``gzip`` and
+    ``zcat`` read back as one stream, and is fsynced before ``write``
+    returns, so the rows can be deleted from the database afterwards. A
+    crash between the two archives the batch again on the next run; rows
+    keep their ids, so duplicates are easy to drop when reading.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, table, when):
+        return os.path.join(self.directory, table, when.strftime('%Y-%m') + '.ndjson.gz')
+
+    def write(self, table, records, timestamp_key):
+        """Archive ``records`` (mappings) partitioned by their ``timestamp_key`` month."""
+        partitions = defaultdict(list)
+        for record in records:
+            partitions[self.path(table, record[timestamp_key])].append(record)
+        for path, rows in partitions.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = gzip.compress(''.join(iter_ndjson(rows)).encode('utf-8'), mtime=0)
+            with open(path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        return len(partitions)
+
+
+def remove_if_idle(path, grace, now=None):
+    """Delete ``path`` unless it was modified in the last ``grace`` seconds.
+
+    Writers touch a blob when they reuse it, so a blob an upload is about
+    to point to again is never removed. Returns the bytes freed, or None if
+    nothing was removed.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if (now or time.time()) - stat.st_mtime < grace:
+        return None
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return None
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass  # not empty
+    return stat.st_size
+
+
+def incremental_vacuum(engine, pages, pause=0.0):
+    """Return free SQLite pages to the filesystem, ``pages`` at a time.
+
+    Only databases created with ``auto_vacuum=INCREMENTAL`` (or converted
+    with one full ``VACUUM``) can do this; returns None for others and for
+    databases other than SQLite, else the number of pages freed.
+    """
+    if engine.dialect.name != 'sqlite':
+        return None
+    with engine.connect() as connection:
+        if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            return None
+        freed = 0
+        while True:
+            free = connection.exec_driver_sql('PRAGMA freelist_count').scalar()
+            if not free:
+                return freed
+            # The pragma frees one page per step; sqlite3 steps a statement
+            # once, while executescript() runs it to the end
+            connection.connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+            freed += min(free, pages)
+            if pause:
+                time.sleep(pause)
+
+
+class PeriodicTask:
+    """Runs ``function`` every ``interval`` seconds in one process of many.
+
+    Each worker starts a thread, but a run only happens while holding an
+    exclusive lock on ``lock_path``, and the lock file records when the last
+    run finished, so however many workers there are the task runs about
+    once per interval.
+    """
+
+    def __init__(self, function, interval, lock_path):
+        self.function = function
+        self.interval = interval
+        self.lock_path = lock_path
+        self.runs = 0
+        self._pid = None
+        self._stop = threading.Event()
+        atexit.register(self.close)
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or not self.interval:
+            return
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='periodic-task', daemon=True).start()
+
+    def run_once(self, only_if_due=False):
+        """Run now unless another process is running; returns the result or None.
+
+        With ``only_if_due``, also skip if any process ran the task less
+        than an interval ago.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        with open(self.lock_path, 'a+') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                lock.seek(0)
+                last_run = float(lock.read() or 0)
+                if only_if_due and time.time() - last_run < self.interval:
+                    return None
+                result = self.function()
+                self.runs += 1
+                lock.seek(0)
+                lock.truncate()
+                lock.write(str(time.time()))
+                lock.flush()
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once(only_if_due=True)
+            except Exception:
+                logger.exception('Periodic task %s failed', getattr(self.function, '__name__', self.function))
+
+    def close(self):
+        self._stop.set()
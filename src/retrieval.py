@@ -0,0 +1,191 @@
+"""BM25 retrieval over a corpus of FAQ question/answer pairs.
+
+The index is a sparse term-by-document matrix stored in CSR form: for every
+term, ``term_ptr`` delimits a run of ``doc_ids`` and their precomputed BM25
+``weights``. Scoring a message is a single sum over the rows of its terms.
+When NumPy is installed that sum is vectorized; otherwise a pure Python loop
+over the same arrays is used.
+
+Indexes are saved as snapshots (see ``snapshot.py``) and memory-mapped back,
+so worker processes load them without re-tokenizing the corpus.
+"""
+from array import array
+import json
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from matcher import STOPWORDS, normalize
+from snapshot import Snapshot, SnapshotWriter
+
+
+def load_corpus(path):
+    """Read FAQ entries from a JSON Lines file of ``{"question", "answer"}`` objects."""
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                entries.append((item['question'], item['answer']))
+    return entries
+
+
+def terms(text):
+    return [token for token in normalize(text) if token not in STOPWORDS]
+
+
+class FAQIndex:
+    """BM25 index answering a message with the closest FAQ entry."""
+
+    def __init__(self, vocabulary, idf, term_ptr, doc_ids, weights, questions, answers, k1=1.5, b=0.75):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.questions = questions
+        self.answers = answers
+        self.k1 = k1
+        self.b = b
+        self.max_idf = max(idf) if len(idf) else 0.0
+
+    def __len__(self):
+        return len(self.answers)
+
+    @classmethod
+    def build(cls, entries, k1=1.5, b=0.75):
+        questions = [question for question, _ in entries]
+        answers = [answer for _, answer in entries]
+        # Questions are indexed together with their answers; question terms
+        # count twice because they are phrased the way users ask.
+        documents = [terms(question) * 2 + terms(answer) for question, answer in entries]
+        avg_length = (sum(len(doc) for doc in documents) / len(documents)) if documents else 0.0
+
+        postings = {}
+        for doc_id, doc in enumerate(documents):
+            counts = {}
+            for term in doc:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf, len(doc)))
+
+        vocabulary = {}
+        idf = array('f')
+        term_ptr = array('i', [0])
+        doc_ids = array('i')
+        weights = array('f')
+        for term in sorted(postings):
+            rows = postings[term]
+            term_idf = math.log(1 + (len(documents) - len(rows) + 0.5) / (len(rows) + 0.5))
+            vocabulary[term] = len(idf)
+            idf.append(term_idf)
+            for doc_id, tf, length in rows:
+                norm = k1 * (1 - b + b * length / avg_length)
+                doc_ids.append(doc_id)
+                weights.append(term_idf * tf * (k1 + 1) / (tf + norm))
+            term_ptr.append(len(doc_ids))
+        return cls(vocabulary, idf, term_ptr, doc_ids, weights, questions, answers, k1, b)
+
+    def scores(self, message):
+        """Return ``(scores, upper_bound)`` for ``message`` against every entry."""
+        query = set(terms(message))
+        rows = []
+        upper_bound = 0.0
+        for term in query:
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                # Unknown words make a match less certain
+                upper_bound += self.max_idf * (self.k1 + 1)
+                continue
+            upper_bound += self.idf[term_id] * (self.k1 + 1)
+            rows.append((self.term_ptr[term_id], self.term_ptr[term_id + 1]))
+
+        if np is not None:
+            doc_ids = np.frombuffer(self.doc_ids, dtype=np.int32)
+            weights = np.frombuffer(self.weights, dtype=np.float32)
+            if rows:
+                index = np.concatenate([np.arange(start, end) for start, end in rows])
+                scores = np.bincount(doc_ids[index], weights[index], minlength=len(self))
+            else:
+                scores = np.zeros(len(self))
+            return scores, upper_bound
+
+        scores = [0.0] * len(self)
+        for start, end in rows:
+            for doc_id, weight in zip(self.doc_ids[start:end], self.weights[start:end]):
+                scores[doc_id] += weight
+        return scores, upper_bound
+
+    def search(self, message, min_confidence=0.0):
+        """Return ``(entry_id, confidence)`` for the best entry, or None.
+
+        Confidence is the BM25 score divided by the highest score the
+        message's terms could reach, so it falls between 0 and 1.
+        """
+        if not len(self):
+            return None
+        scores, upper_bound = self.scores(message)
+        if upper_bound <= 0:
+            return None
+        if np is not None:
+            best = int(np.argmax(scores))
+        else:
+            best = max(range(len(scores)), key=scores.__getitem__)
+        confidence = float(scores[best]) / upper_bound
+        if scores[best] <= 0 or confidence < min_confidence:
+            return None
+        return best, confidence
+
+    def covers(self, entry_id, message, min_share=0.5):
+        """Whether entry ``entry_id``'s question shares most of ``message``'s words.
+
+        Stopwords count here: "when will I get my refund?" is close to "When
+        will I receive my refund?", while the lone word "refund" is not.
+        """
+        tokens = set(normalize(message))
+        shared = tokens & set(normalize(self.questions[entry_id]))
+        return len(shared) >= 2 and len(shared) >= min_share * len(tokens)
+
+    def answer(self, message, min_confidence):
+        hit = self.search(message, min_confidence)
+        return None if hit is None else self.answers[hit[0]]
+
+    def to_snapshot(self, writer, prefix):
+        writer.meta[prefix + 'k1'] = self.k1
+        writer.meta[prefix + 'b'] = self.b
+        writer.add_strings(prefix + 'terms', sorted(self.vocabulary, key=self.vocabulary.get))
+        writer.add_strings(prefix + 'questions', self.questions)
+        writer.add_strings(prefix + 'answers', self.answers)
+        writer.add_array(prefix + 'idf', 'f', self.idf)
+        writer.add_array(prefix + 'term_ptr', 'i', self.term_ptr)
+        writer.add_array(prefix + 'doc_ids', 'i', self.doc_ids)
+        writer.add_array(prefix + 'weights', 'f', self.weights)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, prefix):
+        return cls(
+            snapshot.strings(prefix + 'terms'),
+            snapshot.array(prefix + 'idf'),
+            snapshot.array(prefix + 'term_ptr'),
+            snapshot.array(prefix + 'doc_ids'),
+            snapshot.array(prefix + 'weights'),
+            snapshot.strings(prefix + 'questions'),
+            snapshot.strings(prefix + 'answers'),
+            snapshot.meta[prefix + 'k1'],
+            snapshot.meta[prefix + 'b'],
+        )
+
+    def save(self, path):
+        """Write the index to ``path`` atomically."""
+        writer = SnapshotWriter()
+        self.to_snapshot(writer, '')
+        writer.write(path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map an index written by :meth:`save`."""
+        return cls.from_snapshot(Snapshot(path), '')
@@ -0,0 +1,167 @@
+"""Read-only binary snapshots of numeric arrays and string tables.
+
+A snapshot file is a small JSON header followed by 4-byte aligned sections.
+Readers memory-map the file and expose sections as ``memoryview`` casts and
+lazily decoded string tables, so every process that opens the same snapshot
+shares its pages through the OS page cache instead of holding its own copy.
+"""
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'CHATSNP1'
+
+
+class StringTable:
+    """Sequence of strings stored as offsets into a UTF-8 blob.
+
+    Tables written from a sorted list support ``get`` lookups by binary search.
+    """
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return str(self._blob[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, key):
+        # Sorted tables only, like get()
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """Return the position of ``key`` in a sorted table, or ``default``."""
+        i = bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return default
+
+
+class Postings:
+    """Mapping from the keys of a sorted string table to runs of integers."""
+
+    def __init__(self, keys, ptr, values):
+        self.keys = keys
+        self.ptr = ptr
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.keys.get(key) is not None
+
+    def get(self, key, default=None):
+        i = self.keys.get(key)
+        if i is None:
+            return default
+        return self.values[self.ptr[i]:self.ptr[i + 1]]
+
+
+class SnapshotWriter:
+    """Collects sections in memory and writes them out as one snapshot file."""
+
+    def __init__(self, meta=None):
+        self.meta = dict(meta or {})
+        self._sections = []
+
+    def add_array(self, name, typecode, values):
+        if typecode not in ('i', 'f'):
+            raise ValueError('only 4-byte int and float sections are supported')
+        self._sections.append((name, typecode, array(typecode, values).tobytes()))
+
+    def add_strings(self, name, strings):
+        offsets = array('i', [0])
+        blob = bytearray()
+        for value in strings:
+            blob += value.encode('utf-8')
+            offsets.append(len(blob))
+        self.add_array(name + '.offsets', 'i', offsets)
+        blob += b'\0' * (-len(blob) % 4)
+        self._sections.append((name + '.blob', 'B', bytes(blob)))
+
+    def add_postings(self, name, mapping):
+        """Store a ``{str: [int, ...]}`` mapping as a sorted table plus CSR runs."""
+        keys = sorted(mapping)
+        ptr = [0]
+        values = []
+        for key in keys:
+            values.extend(mapping[key])
+            ptr.append(len(values))
+        self.add_strings(name + '.keys', keys)
+        self.add_array(name + '.ptr', 'i', ptr)
+        self.add_array(name + '.values', 'i', values)
+
+    def write(self, path):
+        """Write the snapshot to ``path`` atomically."""
+        layout = {}
+        offset = 0
+        for name, typecode, data in self._sections:
+            layout[name] = [typecode, offset, len(data)]
+            offset += len(data)
+        header = json.dumps({'meta': self.meta, 'sections': layout}).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 4)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('<I', len(header)))
+                f.write(header)
+                for _, _, data in self._sections:
+                    f.write(data)
+            # Readers holding the old file keep their mapping of the old inode
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class Snapshot:
+    """Memory-mapped view of a file written by :class:`SnapshotWriter`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+        (header_length,) = struct.unpack_from('<I', view, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(view[start:start + header_length]))
+        self.meta = header['meta']
+        self._sections = header['sections']
+        self._data = view[start + header_length:]
+
+    def __contains__(self, name):
+        return name in self._sections or name + '.offsets' in self._sections
+
+    def array(self, name):
+        typecode, offset, length = self._sections[name]
+        return self._data[offset:offset + length].cast(typecode)
+
+    def strings(self, name):
+        typecode, offset, length = self._sections[name + '.blob']
+        return StringTable(self.array(name + '.offsets'), self._data[offset:offset + length])
+
+    def postings(self, name):
+        return Postings(self.strings(name + '.keys'), self.array(name + '.ptr'), self.array(name + '.values'))
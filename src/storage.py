@@ -0,0 +1,71 @@
+"""Database engine configuration: where the database is and how to talk to it."""
+import os
+
+# Applied to every new SQLite connection. WAL lets readers work alongside
+# the single writer; NORMAL sync is durable across crashes of the process
+# (only an OS crash can lose the last commits); busy_timeout makes a writer
+# wait for the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    # Lets the retention job hand freed pages back a few at a time; takes
+    # effect for new databases (or after one VACUUM)
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,  # negative means KiB, so 16MB per connection
+    'temp_store': 'MEMORY',
+}
+
+
+def normalize_database_uri(uri):
+    # Heroku-style URLs use a scheme SQLAlchemy no longer accepts
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def database_uri(default):
+    """Return the database URI from ``DATABASE_URL``, or ``default``."""
+    return normalize_database_uri(os.environ.get('DATABASE_URL', default))
+
+
+def engine_options(uri, pool_size=10, max_overflow=5):
+    """Engine options for ``uri`` with a pool of ``pool_size`` connections per process."""
+    options = {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        # Compiled statements are reused across requests; keep every query
+        # the app runs in the cache
+        'query_cache_size': 1200,
+    }
+    if uri.startswith('sqlite'):
+        options['connect_args'] = {
+            # Threads share the pool, not connections; statements prepared
+            # by sqlite3 are cached per connection
+            'check_same_thread': False,
+            'cached_statements': 256,
+            'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+        }
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            # In-memory databases live in a single connection
+            del options['pool_size'], options['max_overflow']
+    else:
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = 1800
+    return options
+
+
+def apply_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """Run ``pragmas`` on each connection ``engine`` opens, if it is SQLite."""
+    from sqlalchemy import event
+
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
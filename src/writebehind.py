@@ -0,0 +1,155 @@
+"""Write-behind batching for rows that do not need to be written inline."""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Queued by flush() to make the writer thread stop collecting and write now
+_FLUSH = object()
+
+
+class WriteBehindQueue:
+    """Collects rows in a bounded queue and writes them in batches.
+
+    A background thread hands rows to ``write_batch`` once ``batch_size`` rows
+    are waiting or ``flush_interval`` seconds have passed since the first of
+    them arrived, so a row reaches the database within about two intervals.
+    When the queue is full, ``put`` waits up to ``put_timeout`` seconds and
+    then writes the row itself, which slows producers down to the speed of
+    the database instead of dropping rows.
+    """
+
+    def __init__(self, write_batch, batch_size=100, flush_interval=0.5, max_size=10000, put_timeout=1.0):
+        self.write_batch = write_batch
+        self.written = 0
+        self.failed = 0
+        self.inline_writes = 0
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        self._pending = 0
+        self._pending_changed = threading.Condition()
+        self.configure(batch_size, flush_interval, max_size, put_timeout)
+        atexit.register(self.close)
+
+    def configure(self, batch_size=100, flush_interval=0.5, max_size=10000, put_timeout=1.0):
+        """Set the constructor's sizes and timeouts; only before the first :meth:`put`."""
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(max_size)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._pending_changed:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            # A forked worker inherits the queue but not the writer thread
+            self._queue = queue.Queue(self.max_size)
+            self._pending = 0
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, row):
+        self._ensure_started()
+        with self._pending_changed:
+            self._pending += 1
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            self.inline_writes += 1
+            self._write([row])
+
+    def flush(self):
+        """Write everything queued so far and wait for it to be written."""
+        if self._thread is None:
+            return
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._wait_for_writer()
+        else:
+            self._drain()
+
+    def _wait_for_writer(self):
+        if self._pending == 0:
+            return
+        # Wake the writer so it writes what it has without waiting for
+        # the batch deadline; rows still go out in the order they came in
+        try:
+            self._queue.put(_FLUSH, timeout=self.put_timeout)
+        except queue.Full:
+            pass
+        with self._pending_changed:
+            while self._pending > 0 and self._thread.is_alive():
+                self._pending_changed.wait(self.flush_interval)
+
+    def _drain(self):
+        # No writer thread here (stopped, or not ours after a fork): write
+        # what is queued from this thread
+        batch = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not _FLUSH:
+                batch.append(row)
+        if batch:
+            self._write(batch)
+
+    def close(self):
+        """Stop the writer thread after writing every queued row."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        try:
+            self._queue.put_nowait(_FLUSH)  # wake the writer rather than wait out its poll
+        except queue.Full:
+            pass
+        self._thread.join(self.flush_interval * 4)
+        self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                row = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if row is _FLUSH:
+                continue
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is _FLUSH:
+                    break
+                batch.append(row)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.write_batch(batch)
+            self.written += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception('Failed to write %d queued rows', len(batch))
+        finally:
+            with self._pending_changed:
+                self._pending -= len(batch)
+                self._pending_changed.notify_all()
@@ -0,0 +1,126 @@
+"""Serve a WSGI app to an ASGI server, streaming both ways on a thread pool.
+
+asgiref's ``WsgiToAsgi`` reads the whole request body into a temporary
+file before calling the app, and by default runs every request on one
+shared thread, so a slow request holds up all the others. Here each
+request runs on its own pool thread: the app reads the body while the
+client is still sending it, and response chunks go out as the app yields
+them. A thread blocks on the event loop for every body message it reads
+or writes, so the server's flow control reaches the app in both
+directions.
+"""
+import asyncio
+import io
+import sys
+
+
+class RequestBody(io.RawIOBase):
+    """The request body, received from the event loop as the app reads it."""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                # The client went away; the app sees a short body
+                self._more = False
+            else:
+                self._buffer = message.get('body', b'')
+                self._more = message.get('more_body', False)
+        count = min(len(buffer), len(self._buffer))
+        buffer[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+
+def build_environ(scope, body):
+    """The WSGI environ of the HTTP request ``scope``."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        # The body ends where the client's does, with or without a length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class WsgiBridge:
+    """An ASGI app running the WSGI app ``wsgi_app`` on ``executor``'s threads."""
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run, scope, receive, send, loop)
+
+    def _run(self, scope, receive, send, loop):
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+            ]
+            return write
+
+        def write(data):
+            # Headers go out with the first non-empty chunk, as WSGI requires
+            if not response.get('started'):
+                response['started'] = True
+                call({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            if data:
+                call({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        environ = build_environ(scope, RequestBody(receive, loop))
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+            write(b'')
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+        call({'type': 'http.response.body', 'body': b''})